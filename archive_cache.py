@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bookkeeping for reading the whole archive incrementally.
+
+remembers, for every saved html file and image, its modification time and size
+and the hash computed from it, so that `uwecscraper.read_daily_source` and
+`uwecscraper.read_daily_images` only have to hash files that are new or changed
+since the last time they ran.
+
+the cache is a pickle, next to the hash index.  if it's deleted, it just gets rebuilt.
+"""
+
+import os
+import pickle
+from os.path import join
+
+import hash_index
+
+
+# bumped whenever what's cached changes meaning, so an old cache is dropped rather than mixed in.
+# 2: source hashes are of the saved text (`uwecscraper.source_hash_of_text`), not of the re-parsed soup.
+version = 2
+
+
+def cache_location(path):
+    return join(hash_index.meta_location(path), 'archive_cache.pkl')
+
+
+def file_key(fn):
+    """
+    what we check to decide whether a file changed since we last hashed it.
+    """
+    st = os.stat(fn)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def load(path):
+    """
+    the cache for the archive at `path`, as a dict with keys 'source' and 'images'.
+    each is a dict from filename (relative to `path`) to `(file_key, hash)`.
+    a cache from another `version` is dropped.
+    """
+    try:
+        with open(cache_location(path), 'rb') as fin:
+            cache = pickle.load(fin)
+        if cache.get('version')==version:
+            return cache
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    return {'version': version, 'source': {}, 'images': {}}
+
+
+def save(path, cache):
+    os.makedirs(hash_index.meta_location(path), exist_ok=True)
+    tmp = cache_location(path) + '.tmp'
+    with open(tmp, 'wb') as fout:
+        pickle.dump(cache, fout)
+    os.replace(tmp, cache_location(path))
+
+
+def lookup(entries, relname, key):
+    """
+    the cached hash for `relname`, if the file hasn't changed since; otherwise `None`.
+    """
+    entry = entries.get(relname)
+    if entry is not None and entry[0]==key:
+        return entry[1]
+    return None
@@ -4,10 +4,257 @@
 Created on Thu Sep 17 17:35:10 2020
 
 @author: amethyst
+
+run with no arguments to poll once (this is what the old launchd StartInterval job did).
+
+run with `--daemon` to stay resident and poll on a schedule, so the imports,
+http session and hash index are only set up once.  each poll's outcome is written
+to a small json status file.  stops cleanly on SIGTERM / SIGINT.
+
+run with `--jobs jobs.json` to poll several dashboards from this one process, each on its own
+schedule, over one shared connection pool.  see `load_jobs` for the file, and `jobs.example.json`.
 """
 
 import uwecscraper
+import hash_index
+import fetching
+import poll_stats
 import datetime
-print('running autosave at {}'.format(datetime.datetime.now()))
-uwecscraper.gather_and_save()
+import argparse
+import json
+import os
+import random
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from os.path import join
+
+
+def poll_once(path = uwecscraper.default_data_location, stats_log = None, prom_file = None):
+    print('running autosave at {}'.format(datetime.datetime.now()))
+    return uwecscraper.gather_and_save(path=path, stats_log=stats_log, prom_file=prom_file)
+
+
+def next_delay(interval, jitter, failures, max_backoff):
+    """
+    seconds until the next poll.
+
+    the interval doubles with each consecutive failure, up to `max_backoff`,
+    and is then spread by +/- `jitter` (a fraction of the delay), so polls don't line up with anything.
+    """
+    delay = min(interval * 2**min(failures, 32), max(interval, max_backoff))
+    return delay * (1 + random.uniform(-jitter, jitter))
+
+
+def write_status(status_file, status):
+    """
+    writes the status json atomically, so a reader never sees half of it.
+    """
+    tmp = status_file + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as fout:
+        json.dump(status, fout, indent=2)
+    os.replace(tmp, status_file)
+
+
+def stop_on_signals():
+    """
+    an event that gets set on SIGTERM or SIGINT.
+    """
+    stopping = threading.Event()
+    def stop(signum, frame):
+        print('got signal {}, stopping after this poll'.format(signum))
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    return stopping
+
+
+def run_daemon(interval = 300, jitter = 0.1, max_backoff = 3600, status_file = None,
+               path = uwecscraper.default_data_location, stats_log = None, prom_file = None):
+    """
+    polls forever, until SIGTERM or SIGINT.
+
+    a poll in progress is allowed to finish before stopping.
+    `stats_log` and `prom_file` are passed on to `uwecscraper.gather_and_save`.
+    """
+    if status_file is None:
+        status_file = join(hash_index.meta_location(path), 'last_poll.json')
+    os.makedirs(os.path.dirname(os.path.abspath(status_file)), exist_ok=True)
+
+    stopping = stop_on_signals()
+
+    failures = 0
+    polls = 0
+    while not stopping.is_set():
+        started = time.time()
+        status = {'started': datetime.datetime.fromtimestamp(started).isoformat(), 'pid': os.getpid()}
+        try:
+            soup = poll_once(path, stats_log, prom_file)
+            failures = 0
+            status['outcome'] = 'unchanged' if soup is None else 'fetched'
+        except Exception as e:
+            failures += 1
+            status['outcome'] = 'error'
+            status['error'] = repr(e)
+            traceback.print_exc()
+        polls += 1
+
+        delay = next_delay(interval, jitter, failures, max_backoff)
+        status['duration'] = round(time.time() - started, 3)
+        status['consecutive_failures'] = failures
+        status['polls'] = polls
+        status['next_poll'] = datetime.datetime.fromtimestamp(time.time() + delay).isoformat()
+        write_status(status_file, status)
+
+        stopping.wait(delay)
+
+    hash_index.close(path)
+    print('stopped at {}'.format(datetime.datetime.now()))
+
+
+job_defaults = {'extractor': 'uwec', 'interval': 300, 'jitter': 0.1, 'max_backoff': 3600}
+
+
+def load_jobs(jobs_file):
+    """
+    reads a job set: a json list of targets, each a dict with
+
+        name         unique; used in the logs and metrics
+        url          the dashboard page
+        path         where its archive is (a folder, or `s3://bucket/prefix`)
+        extractor    the registered extractor for its pages (see `uwecscraper.register_extractor`), default 'uwec'
+        interval     seconds between its polls, default 300.  it's never polled more often than this,
+                     so this is its rate limit.
+        jitter, max_backoff    as for `run_daemon`
+
+    raises ValueError for a job set that doesn't make sense.
+    """
+    with open(jobs_file, 'r', encoding='utf-8') as fin:
+        jobs = [dict(job_defaults, **j) for j in json.load(fin)]
+
+    names = [j.get('name') for j in jobs]
+    if len(set(names))!=len(names) or None in names:
+        raise ValueError('every job needs a name, and the names must be different')
+    for j in jobs:
+        if 'url' not in j or 'path' not in j:
+            raise ValueError('job {} needs a url and a path'.format(j['name']))
+        if j['extractor'] not in uwecscraper.extractors:
+            raise ValueError('job {} has unknown extractor {!r}'.format(j['name'], j['extractor']))
+    return jobs
+
+
+def poll_job(job, stats_log = None, prom_dir = None):
+    prom_file = join(prom_dir, job['name']+'.prom') if prom_dir is not None else None
+    return uwecscraper.gather_and_save(job['url'], path=job['path'], extractor=job['extractor'],
+                                       stats=poll_stats.PollStats(job['name']), stats_log=stats_log, prom_file=prom_file)
+
+
+def count_hosts(jobs):
+    """
+    how many hosts the `jobs` fetch from: each one's page, and its images, as far as its last poll remembers
+    (a dashboard's images are often on another host than its page).  a job never polled yet
+    is counted as having its own image host.
+    """
+    from urllib.parse import urlsplit
+    hosts = set()
+    unknown = 0
+    for j in jobs:
+        hosts.add(urlsplit(j['url']).netloc)
+        cached = hash_index.get_http_cache(j['path'], j['url'])
+        if cached is None:
+            unknown += 1
+        else:
+            hosts.update(urlsplit(u).netloc for u in cached['links'])
+    return len(hosts) + unknown
+
+
+def run_jobs(jobs, threads = 4, stats_log = None, prom_dir = None):
+    """
+    polls every target in `jobs` (see `load_jobs`) on its own schedule, until SIGTERM or SIGINT.
+
+    at most `threads` polls run at once, all over one shared http session, so a target costs
+    a few dicts and a thread's share of time, not a process.  each target backs off on its own failures,
+    and its status is written to `last_poll.json` in its archive's bookkeeping folder, as with `run_daemon`.
+    `stats_log` gets every poll's json stats line; `prom_dir`, if given, gets a `<name>.prom` per target.
+    """
+    fetching.use_session(fetching.make_session(workers=threads*fetching.default_workers, hosts=count_hosts(jobs)))
+    if prom_dir is not None:
+        os.makedirs(prom_dir, exist_ok=True)
+    stopping = stop_on_signals()
+
+    state = {j['name']: {'due': time.time(), 'failures': 0, 'polls': 0} for j in jobs}
+    running = {} # future -> (job, time started)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while not stopping.is_set() or len(running)>0:
+            now = time.time()
+            busy = {job['name'] for job, started in running.values()}
+            if not stopping.is_set():
+                for job in jobs:
+                    if job['name'] not in busy and state[job['name']]['due']<=now:
+                        running[pool.submit(poll_job, job, stats_log, prom_dir)] = (job, now)
+                        busy.add(job['name'])
+
+            next_due = min((state[j['name']]['due'] for j in jobs if j['name'] not in busy), default=now+1)
+            timeout = min(max(0, next_due-now), 1)
+            if len(running)==0:
+                stopping.wait(timeout)
+                continue
+
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+            for f in done:
+                job, started = running.pop(f)
+                st = state[job['name']]
+                status = {'target': job['name'], 'url': job['url'], 'pid': os.getpid(),
+                          'started': datetime.datetime.fromtimestamp(started).isoformat()}
+                try:
+                    status['outcome'] = 'unchanged' if f.result() is None else 'fetched'
+                    st['failures'] = 0
+                except Exception as e:
+                    st['failures'] += 1
+                    status['outcome'] = 'error'
+                    status['error'] = repr(e)
+                    print('poll of {} failed:'.format(job['name']))
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                st['polls'] += 1
+
+                delay = next_delay(job['interval'], job['jitter'], st['failures'], job['max_backoff'])
+                st['due'] = time.time() + delay
+                status['duration'] = round(time.time() - started, 3)
+                status['consecutive_failures'] = st['failures']
+                status['polls'] = st['polls']
+                status['next_poll'] = datetime.datetime.fromtimestamp(st['due']).isoformat()
+                status_file = join(hash_index.meta_location(job['path']), 'last_poll.json')
+                os.makedirs(os.path.dirname(status_file), exist_ok=True)
+                write_status(status_file, status)
+
+    print('stopped at {}'.format(datetime.datetime.now()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='save the UWEC covid dashboard, if it changed.')
+    parser.add_argument('--daemon', action='store_true', help='stay resident, and poll on a schedule')
+    parser.add_argument('--interval', type=float, default=300, help='seconds between polls, in daemon mode')
+    parser.add_argument('--jitter', type=float, default=0.1, help='random spread of the interval, as a fraction of it')
+    parser.add_argument('--max-backoff', type=float, default=3600, help='longest wait between polls when they keep failing')
+    parser.add_argument('--status-file', default=None, help='where to write the status of the last poll')
+    parser.add_argument('--path', default=uwecscraper.default_data_location, help='the data location')
+    parser.add_argument('--stats-log', default=None, help="append each poll's timings and counters, as a json line, to this file")
+    parser.add_argument('--prom-file', default=None, help="write the last poll's timings and counters here, in prometheus text format")
+    parser.add_argument('--jobs', default=None, help='poll all the dashboards in this json job set, as a daemon (see load_jobs)')
+    parser.add_argument('--threads', type=int, default=4, help='most polls at once, with --jobs')
+    parser.add_argument('--prom-dir', default=None, help='with --jobs, write each target\'s prometheus text file here, as <name>.prom')
+    args = parser.parse_args()
+
+    if args.jobs is not None:
+        run_jobs(load_jobs(args.jobs), args.threads, args.stats_log, args.prom_dir)
+    elif args.daemon:
+        run_daemon(args.interval, args.jitter, args.max_backoff, args.status_file, args.path,
+                   args.stats_log, args.prom_file)
+    else:
+        poll_once(args.path, args.stats_log, args.prom_file)
+
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rebuilds the time series table from the snapshot archive, in one go.
+
+each day's numbers come from the last snapshot of that day with new data, read from its html
+where the page had them there, and ocr'd from its health services tile otherwise
+(see `uwecscraper.daily_numbers_from_archive`).  the table is then written in one pass.
+
+    python backfill.py --out data/table.csv
+
+the default starting totals are those from before our table's first day, 2020-09-04.
+"""
+
+import uwecscraper
+import argparse
+import os
+from os.path import join
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='rebuild the time series table from the snapshot archive.')
+    parser.add_argument('--path', default=uwecscraper.default_data_location, help='the data location')
+    parser.add_argument('--out', default=join(here, 'data', 'table.csv'), help='the table to (over)write')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes for parsing and ocr (default: one per cpu)')
+    parser.add_argument('--start-pos', type=int, default=9, help='total positives from before the first day')
+    parser.add_argument('--start-test', type=int, default=43, help='total tests from before the first day')
+    parser.add_argument('--dry-run', action='store_true', help="print the days found, but don't write the table")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        print(uwecscraper.daily_numbers_from_archive(args.path, args.workers).to_string())
+        return
+
+    table = uwecscraper.build_table_from_archive(args.out, args.path, args.start_pos, args.start_test, args.workers)
+    print('wrote {} days to {}'.format(table.shape[0], args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+times the hot paths of the scraper against a synthetic archive, at several sizes.
+
+makes an archive in the `default_data_location` layout -- N `<iso>_0.html` snapshots,
+each with an `<iso>_0imgs/` folder of png tiles -- and a local http server standing in
+for the dashboard, then times
+
+    read_daily_images_and_source   (cold, then warm: a second call, as is, with nothing new)
+    find_duplicate_data            (cold, then warm)
+    is_new_data                    (against the local server)
+    add_daily_from_images          (cold, then warm; skipped if tesseract or pytesseract isn't installed)
+    add_new_data                   (appending to a table of N rows; skipped if pytesseract isn't installed,
+                                    since `ocr_tools` needs it)
+
+run from the repo root:
+
+    python benchmarks/archive.py --sizes 10,100,1000 --out bench_archive.json
+
+results are written as json, one record per (size, benchmark), so runs can be compared over time.
+"""
+
+import argparse
+import contextlib
+import datetime
+import functools
+import hashlib
+import http.server
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from os.path import join
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+import uwecscraper
+import hash_index
+
+tile_names = ['UW-EauClaireCOVID-19DataTrackerDashboardHSTiles_HealthServicesTiles_1.png',
+              'UW-EauClaireCOVID-19DataTrackerDashboardHSTiles_Trends_2.png',
+              'UW-EauClaireCOVID-19DataTrackerDashboardHSTiles_Quarantine_3.png']
+
+
+def make_tile(seed, size = (800, 260)):
+    """
+    png bytes for a tile.  a real png with the numbers drawn on it, if PIL is around, so the ocr has something to read.
+    """
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        return b'\x89PNG\r\n\x1a\n' + hashlib.sha256(str(seed).encode()).digest()*64
+
+    im = Image.new('RGB', size, 'white')
+    ImageDraw.Draw(im).text((20, 160), '{} {} {}%'.format(seed % 50, 200 + seed % 300, round(100*(seed % 50)/(200 + seed % 300), 1)), fill='black')
+    out = io.BytesIO()
+    im.save(out, format='PNG')
+    return out.getvalue()
+
+
+def page_html(when, tile_urls):
+    imgs = ''.join('<img src="{}"/>'.format(u) for u in tile_urls)
+    return ('<html><body><h4>Updated {}</h4><table>{}</table>{}</body></html>'
+            .format(when.strftime('%I:%M a.m. %m/%d/%y').lstrip('0'),
+                    ''.join('<tr><td>row {}</td><td>{}</td></tr>'.format(ii, ii*7) for ii in range(12)), imgs))
+
+
+def make_archive(path, n, change_every = 12):
+    """
+    writes `n` snapshots, 5 minutes apart.  the tiles change every `change_every` snapshots,
+    like the real dashboard, where most captures are repeats.
+    """
+    start = datetime.datetime(2020, 9, 25, 0, 0, 0)
+    tiles = {}
+    for ii in range(n):
+        when = start + datetime.timedelta(minutes=5*ii)
+        name = '{}_0'.format(when.isoformat().replace(':', '.'))
+        version = ii // change_every
+
+        folder = join(path, name+'imgs')
+        os.mkdir(folder)
+        for jj, t in enumerate(tile_names):
+            key = (version, jj)
+            if key not in tiles:
+                tiles[key] = make_tile(version*len(tile_names) + jj)
+            with open(join(folder, t), 'wb') as fout:
+                fout.write(tiles[key])
+
+        with open(join(path, name+'.html'), 'w', encoding='utf-8') as fout:
+            fout.write(page_html(when, ['http://example.invalid/tableau/{}'.format(t) for t in tile_names]))
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def dashboard_server(n_tiles = len(tile_names)):
+    """
+    a local http server serving a dashboard page and its tiles.  yields the page's url.
+    """
+    site = tempfile.mkdtemp(prefix='uwec_bench_site_')
+    os.makedirs(join(site, 'tableau'))
+    for jj, t in enumerate(tile_names[:n_tiles]):
+        with open(join(site, 'tableau', t), 'wb') as fout:
+            fout.write(make_tile(10000 + jj))
+
+    handler = functools.partial(QuietHandler, directory=site)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    with open(join(site, 'index.html'), 'w', encoding='utf-8') as fout:
+        fout.write(page_html(datetime.datetime(2021, 1, 1, 10, 0), ['{}/tableau/{}'.format(base, t) for t in tile_names[:n_tiles]]))
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield base + '/index.html'
+    finally:
+        server.shutdown()
+        shutil.rmtree(site, ignore_errors=True)
+
+
+def timed(fn, *args, **kwargs):
+    """
+    runs fn, with its printing silenced.  returns seconds taken.
+    """
+    t = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn(*args, **kwargs)
+    return time.perf_counter() - t
+
+
+def import_ocr_tools():
+    """
+    `ocr_tools`, or `None` if it can't be imported (it needs pytesseract).
+    """
+    try:
+        import ocr_tools
+        return ocr_tools
+    except ImportError:
+        return None
+
+
+def run_size(n, workdir):
+    path = join(workdir, 'archive_{}'.format(n))
+    os.mkdir(path)
+    make_archive(path, n)
+    results = {}
+
+    results['read_daily_images_and_source.cold'] = timed(uwecscraper.read_daily_images_and_source, path)
+    results['read_daily_images_and_source.warm'] = timed(uwecscraper.read_daily_images_and_source, path)
+
+    os.remove(uwecscraper.archive_cache.cache_location(path))
+    results['find_duplicate_data.cold'] = timed(uwecscraper.find_duplicate_data, path)
+    results['find_duplicate_data.warm'] = timed(uwecscraper.find_duplicate_data, path)
+
+    with dashboard_server() as url:
+        soup = uwecscraper.gather_current(url)
+        def check():
+            staged = uwecscraper.stage_tableau_images(soup, path)
+            try:
+                uwecscraper.is_new_data(soup, staged, path)
+            finally:
+                uwecscraper.discard_staged(staged)
+        results['is_new_data'] = timed(check)
+
+    ocr_tools = import_ocr_tools()
+    if ocr_tools is not None and shutil.which('tesseract') is not None:
+        df = uwecscraper.read_daily_images_and_source(path, parse=False)
+        results['add_daily_from_images.cold'] = timed(uwecscraper.add_daily_from_images, df, path)
+        results['add_daily_from_images.warm'] = timed(uwecscraper.add_daily_from_images, df, path)
+    else:
+        results['add_daily_from_images.cold'] = None
+        results['add_daily_from_images.warm'] = None
+
+    if ocr_tools is not None:
+        import pandas as pd
+        table = join(workdir, 'table_{}.csv'.format(n))
+        days = pd.date_range('2020-01-01', periods=n, freq='D')
+        ocr_tools.build_table(pd.DataFrame({'date': days, 'daily_pos': 5, 'daily_tests': 200}), table)
+        appends = 20
+        def append_rows():
+            for ii in range(appends):
+                ocr_tools.add_new_data([5, 200, 2.5], table, (days[-1] + pd.Timedelta(days=ii+1)).date())
+        results['add_new_data.per_row'] = timed(append_rows) / appends
+    else:
+        results['add_new_data.per_row'] = None
+
+    hash_index.close(path)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks over a synthetic snapshot archive')
+    parser.add_argument('--sizes', default='10,100,1000', help='comma-separated archive sizes (number of snapshots)')
+    parser.add_argument('--out', default=None, help='append json results to this file')
+    parser.add_argument('--keep', action='store_true', help="don't delete the synthetic archives")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='uwec_bench_')
+    hash_index.meta_root = join(workdir, 'meta') # so the bookkeeping goes with the archives
+    run = {'started': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+           'machine': platform.machine(), 'records': []}
+    try:
+        for n in [int(x) for x in args.sizes.split(',')]:
+            results = run_size(n, workdir)
+            for bench, seconds in results.items():
+                run['records'].append({'size': n, 'benchmark': bench, 'seconds': seconds})
+                print('{:>7} {:<40} {}'.format(n, bench, 'skipped' if seconds is None else '{:.4f} s'.format(seconds)))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print('archives left in {}'.format(workdir))
+
+    if args.out is not None:
+        with open(args.out, 'a') as fout:
+            fout.write(json.dumps(run) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+measures how long it takes to start up the autosave entry point,
+using `python -X importtime`, and checks that the heavy analysis
+libraries aren't being imported on the poll path.
+
+it also runs an actual poll that finds nothing changed -- against a local stand-in for the
+dashboard, after a first poll has saved it -- and checks none of them got imported by that either.
+
+run from the repo root:
+
+    python benchmarks/importtime.py
+    python benchmarks/importtime.py --budget 400 --json bench_importtime.json
+
+exits nonzero if a heavy module got imported, or if the total import time is over budget.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# none of these are needed to decide that nothing changed.
+heavy_modules = ['pandas', 'numpy', 'bs4', 'PIL', 'pytesseract', 'ocr_tools']
+
+
+def measure(module = 'autosave_covid'):
+    """
+    imports `module` in a fresh interpreter, with -X importtime.
+
+    returns a dict from top-level module name to cumulative import time in microseconds.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            cwd=repo_root, capture_output=True, text=True)
+    if result.returncode!=0:
+        raise RuntimeError('importing {} failed:\n{}'.format(module, result.stderr))
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative_us)
+    return times
+
+
+poll_script = """
+import json, sys
+import uwecscraper
+uwecscraper.gather_and_save(sys.argv[1], path=sys.argv[2])
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def poll_modules(url, path, meta):
+    """
+    runs one poll of `url` into the archive `path` in a fresh interpreter, with its bookkeeping under `meta`.
+    returns the names of all the modules it had imported by the end.
+    """
+    result = subprocess.run([sys.executable, '-c', poll_script, url, path],
+                            cwd=repo_root, capture_output=True, text=True, env=dict(os.environ, UWEC_SCRAPER_META=meta))
+    if result.returncode!=0:
+        raise RuntimeError('polling failed:\n{}'.format(result.stderr))
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def unchanged_poll_modules():
+    """
+    the top-level modules imported by a poll that finds the page and its images unchanged (all 304s).
+    """
+    sys.path.insert(0, os.path.join(repo_root, 'benchmarks'))
+    import archive
+    workdir = tempfile.mkdtemp(prefix='uwec_bench_poll_')
+    path, meta = os.path.join(workdir, 'archive'), os.path.join(workdir, 'meta')
+    os.mkdir(path)
+    try:
+        with archive.dashboard_server() as url:
+            poll_modules(url, path, meta) # saves it
+            return {m.split('.')[0] for m in poll_modules(url, path, meta)}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def total_ms(times, module):
+    return times.get(module, 0)/1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='startup time of the autosave entry point')
+    parser.add_argument('--module', default='autosave_covid')
+    parser.add_argument('--budget', type=float, default=None, help='fail if importing takes more than this many ms')
+    parser.add_argument('--repeat', type=int, default=5, help='take the best of this many runs')
+    parser.add_argument('--json', default=None, help='also write the results here')
+    parser.add_argument('--no-poll', action='store_true', help="don't run the unchanged poll")
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for ii in range(args.repeat)]
+    best = min(runs, key=lambda t: total_ms(t, args.module))
+
+    slowest = sorted(best.items(), key=lambda kv: -kv[1])[:15]
+    print('import time of {}: {:.1f} ms (best of {})'.format(args.module, total_ms(best, args.module), args.repeat))
+    for name, us in slowest:
+        print('{:>10.1f} ms  {}'.format(us/1000, name))
+
+    imported_heavy = [m for m in heavy_modules if m in best]
+    poll_heavy = []
+    if not args.no_poll:
+        poll_heavy = [m for m in heavy_modules if m in unchanged_poll_modules()]
+
+    if args.json is not None:
+        with open(args.json, 'w') as fout:
+            json.dump({'module': args.module, 'total_ms': total_ms(best, args.module),
+                       'heavy_imported': imported_heavy, 'heavy_imported_by_unchanged_poll': poll_heavy,
+                       'times_us': best}, fout, indent=2)
+
+    failed = False
+    if len(imported_heavy)>0:
+        print('heavy modules imported on the poll path: {}'.format(', '.join(imported_heavy)))
+        failed = True
+    if len(poll_heavy)>0:
+        print('heavy modules imported by a poll that found nothing changed: {}'.format(', '.join(poll_heavy)))
+        failed = True
+    if args.budget is not None and total_ms(best, args.module)>args.budget:
+        print('over budget: {:.1f} ms > {:.1f} ms'.format(total_ms(best, args.module), args.budget))
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+checks `storage.S3Backend` against a real s3 api, and the store on top of it, end to end.
+
+by default it starts `moto.server` on a free local port (needs `pip install moto[server]`);
+with `--endpoint`, it uses that instead, like a minio, with credentials from the usual
+boto3 environment variables.  everything it writes is under a fresh prefix, deleted at the end.
+
+it checks, for the s3 backend and, for comparison, the local one:
+
+    list          keys come back relative to the backend's prefix, and only those under the one asked for
+                  (or only those directly in it, not recursively)
+    folders       the folders directly in a folder, and `has_folder`
+    exists        true for a key that's there, false (not an error) for one that isn't
+    put_files     uploads the files, and with `move`, removes them once they're up
+
+and then, with the archive in the bucket:
+
+    migrate_to_store              a synthetic archive (see `archive.make_archive`)
+    read_daily_images_and_source  reads it back, images and all
+    gather_and_save               polls a local stand-in for the dashboard twice: saved, then unchanged
+
+run from the repo root:
+
+    python benchmarks/s3_backend.py
+    python benchmarks/s3_backend.py --endpoint http://127.0.0.1:9000 --bucket uwec
+
+exits nonzero if any check fails.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from os.path import join, isfile
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+sys.path.insert(0, join(repo_root, 'benchmarks'))
+
+import archive
+import blob_store
+import hash_index
+import storage
+import uwecscraper
+
+
+@contextlib.contextmanager
+def moto_server():
+    """
+    a `moto.server` on a free local port, with dummy credentials.  yields its url.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    for k in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        os.environ.setdefault(k, 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    server = subprocess.Popen([sys.executable, '-m', 'moto.server', '-p', str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for ii in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                break
+            except OSError:
+                if server.poll() is not None:
+                    raise RuntimeError('moto.server exited; is moto[server] installed?')
+                time.sleep(0.1)
+        yield 'http://127.0.0.1:{}'.format(port)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+class Checks:
+    """
+    the outcome of each check, printed as it's made.
+    """
+
+    def __init__(self):
+        self.failed = []
+
+    def __call__(self, name, ok, detail = ''):
+        print('{:<4} {}{}'.format('ok' if ok else 'FAIL', name, ' ({})'.format(detail) if detail and not ok else ''))
+        if not ok:
+            self.failed.append(name)
+
+
+def check_backend(check, label, backend, workdir):
+    """
+    the backend operations the store relies on, against an empty `backend`.
+    """
+    backend.put('manifests/a.json', b'a')
+    backend.put_many([('manifests/b.json', b'b'), ('manifests-old/c.json', b'c'), ('blobs/ab/abcd', b'blob')])
+    listed = backend.list('manifests/')
+    check('{} list'.format(label), listed==['manifests/a.json', 'manifests/b.json'], listed)
+    check('{} list of a missing prefix'.format(label), backend.list('nothing/')==[])
+
+    backend.put('top.html', b'top')
+    listed = backend.list('', recursive=False)
+    check('{} list, not recursive'.format(label), listed==['top.html'], listed)
+    found = backend.folders()
+    check('{} folders'.format(label), found==['blobs', 'manifests', 'manifests-old'], found)
+    check('{} folders of a folder'.format(label), backend.folders('blobs/')==['ab'])
+    check('{} has_folder'.format(label), backend.has_folder('blobs/ab/') and not backend.has_folder('nothing/'))
+
+    check('{} exists'.format(label), backend.exists('blobs/ab/abcd'))
+    check('{} exists for a missing key'.format(label), not backend.exists('blobs/ab/missing'))
+
+    files = []
+    for ii in range(4):
+        fn = join(workdir, '{}_{}.bin'.format(label, ii))
+        with open(fn, 'wb') as fout:
+            fout.write(b'file %d' % ii)
+        files.append(fn)
+    backend.put_files([('files/copied/{}'.format(ii), fn) for ii, fn in enumerate(files[:2])])
+    backend.put_files([('files/moved/{}'.format(ii), fn) for ii, fn in enumerate(files[2:])], move=True)
+    check('{} put_files'.format(label), [backend.get('files/copied/{}'.format(ii)) for ii in range(2)]==[b'file 0', b'file 1']
+          and all(isfile(fn) for fn in files[:2]))
+    check('{} put_files with move'.format(label), [backend.get('files/moved/{}'.format(ii)) for ii in range(2)]==[b'file 2', b'file 3']
+          and not any(isfile(fn) for fn in files[2:]))
+
+    fn = join(workdir, '{}_got.bin'.format(label))
+    backend.get_to_file('blobs/ab/abcd', fn)
+    with open(fn, 'rb') as fin:
+        check('{} get_to_file'.format(label), fin.read()==b'blob')
+
+    for key in backend.list(''):
+        backend.delete(key)
+    check('{} delete'.format(label), backend.list('')==[])
+
+
+def check_store(check, location, workdir, n = 30):
+    """
+    an archive migrated into the store at `location`, read back, and polled into.
+    """
+    src = join(workdir, 'archive')
+    os.mkdir(src)
+    archive.make_archive(src, n)
+    with contextlib.redirect_stdout(io.StringIO()):
+        uwecscraper.migrate_to_store(src, store=location)
+    names = blob_store.snapshot_names(location)
+    check('migrate_to_store', len(names)==n, '{} of {} snapshots'.format(len(names), n))
+    check('latest snapshot', uwecscraper.latest_snapshot_name(location)==names[-1])
+
+    df = uwecscraper.read_daily_images_and_source(location)
+    tile = df['images'][0][archive.tile_names[0]]
+    check('read_daily_images_and_source', df.shape[0]==n and tile.as_image().size==(800, 260))
+
+    with archive.dashboard_server() as url, contextlib.redirect_stdout(io.StringIO()):
+        saved = uwecscraper.gather_and_save(url, path=location)
+        again = uwecscraper.gather_and_save(url, path=location)
+    check('gather_and_save', saved is not None and len(blob_store.snapshot_names(location))==n+1)
+    check('gather_and_save, unchanged', again is None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='checks the s3 storage backend against moto or a minio')
+    parser.add_argument('--endpoint', default=None, help="an s3 endpoint to use, instead of starting moto.server")
+    parser.add_argument('--bucket', default='uwec-scraper-check', help='the bucket to use (made if it isn\'t there)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='uwec_s3_check_')
+    hash_index.meta_root = join(workdir, 'meta')
+    prefix = 'check-{}'.format(uuid.uuid4().hex[:8])
+    check = Checks()
+    try:
+        with (moto_server() if args.endpoint is None else contextlib.nullcontext(args.endpoint)) as endpoint:
+            import boto3
+            client = boto3.client('s3', endpoint_url=endpoint)
+            if args.bucket not in [b['Name'] for b in client.list_buckets()['Buckets']]:
+                client.create_bucket(Bucket=args.bucket)
+
+            check_backend(check, 'local', storage.LocalBackend(join(workdir, 'local')), workdir)
+            check_backend(check, 's3', storage.S3Backend(args.bucket, prefix+'/backend', client=client), workdir)
+            if args.endpoint is None: # the bucket is ours alone only on moto
+                check_backend(check, 's3 (no prefix)', storage.S3Backend(args.bucket, '', client=client), workdir)
+
+            location = 's3://{}/{}/store'.format(args.bucket, prefix)
+            storage.register_backend(location, storage.S3Backend(args.bucket, prefix+'/store', endpoint_url=endpoint))
+            try:
+                check_store(check, location, workdir)
+            finally:
+                hash_index.close(location)
+                backend = storage.open_backend(location)
+                for key in backend.list(''):
+                    backend.delete(key)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if len(check.failed)>0:
+        print('{} checks failed'.format(len(check.failed)))
+    sys.exit(1 if len(check.failed)>0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+a content-addressed store for snapshots.
+
+instead of an `<iso>_N.html` file and an `<iso>_Nimgs/` folder of full png copies per save,
+every distinct file is stored once, as a blob named by its sha256, and each snapshot
+is a small json manifest pointing at its blobs.  html is stored gzipped.
+
+layout, inside the data location:
+
+    store/blobs/ab/abcdef...        (an image)
+    store/blobs/12/123456....gz     (html, gzipped)
+    store/manifests/<iso>_N.json
+
+an archive is in this mode if it has a `store` folder, or if it's in an object store (an `s3://bucket/prefix` location).
+`uwecscraper` checks with `in_use`.  all reading and writing goes through the archive's backend (see `storage`).
+use `migrate` to move an existing archive of html files and image folders into a store, local or not.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from os import listdir
+from os.path import join, isfile, isdir
+
+import storage
+
+
+def store_location(path):
+    if storage.is_remote(path):
+        return path
+    return join(path, 'store')
+
+
+def in_use(path):
+    return storage.is_remote(path) or isdir(store_location(path))
+
+
+def init(path):
+    """
+    makes an empty store in the data location `path`, which puts the archive in store mode.
+    an object store needs nothing made.
+    """
+    if not storage.is_remote(path):
+        os.makedirs(join(store_location(path), 'blobs'), exist_ok=True)
+        os.makedirs(join(store_location(path), 'manifests'), exist_ok=True)
+
+
+def blob_key(hexdigest, compressed = False):
+    key = 'blobs/{}/{}'.format(hexdigest[:2], hexdigest)
+    return key+'.gz' if compressed else key
+
+
+def blob_path(path, hexdigest, compressed = False):
+    """
+    the file holding a blob, for opening directly.  `None` if the store isn't local.
+    """
+    return storage.open_backend(path).local_path(blob_key(hexdigest, compressed))
+
+
+def has_blob(path, hexdigest):
+    backend = storage.open_backend(path)
+    return backend.exists(blob_key(hexdigest)) or backend.exists(blob_key(hexdigest, True))
+
+
+def put_bytes(path, data, compress = False):
+    """
+    stores `data`, unless a blob with the same content is already there.
+    returns the hex sha256 of the (uncompressed) data, which is its key.
+    """
+    hexdigest = hashlib.sha256(data).hexdigest()
+    if not has_blob(path, hexdigest):
+        storage.open_backend(path).put(blob_key(hexdigest, compress), gzip.compress(data) if compress else data)
+    return hexdigest
+
+
+def _hash_file(fn):
+    n = hashlib.sha256()
+    with open(fn, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(64*1024), b''):
+            n.update(chunk)
+    return n.hexdigest()
+
+
+def put_files(path, files, move = False):
+    """
+    stores the files in `files`, a list of `(fn, hexdigest)` (hexdigest `None` if not known), as blobs, uncompressed.
+    the ones not already in the store are put in one batch.  copies them, or moves them, if `move`.
+    returns their hex sha256's, in order.
+    """
+    backend = storage.open_backend(path)
+    hexdigests = [h if h is not None else _hash_file(fn) for fn, h in files]
+    todo = {}
+    for (fn, h), hexdigest in zip(files, hexdigests):
+        if hexdigest not in todo and not has_blob(path, hexdigest):
+            todo[hexdigest] = fn
+        elif move:
+            os.remove(fn)
+    backend.put_files([(blob_key(h), fn) for h, fn in todo.items()], move)
+    return hexdigests
+
+
+def put_file(path, fn, hexdigest = None, move = False):
+    """
+    stores the file `fn` as a blob, uncompressed, copying it (or moving it, if `move`).
+    pass its `hexdigest` if it's already known, to save reading the file to hash it.
+    returns the hex sha256.
+    """
+    return put_files(path, [(fn, hexdigest)], move)[0]
+
+
+def get_bytes(path, hexdigest):
+    """
+    the content of a blob, uncompressed.
+    """
+    backend = storage.open_backend(path)
+    if backend.exists(blob_key(hexdigest)):
+        return backend.get(blob_key(hexdigest))
+    return gzip.decompress(backend.get(blob_key(hexdigest, True)))
+
+
+def get_file(path, hexdigest, fn):
+    """
+    writes an (uncompressed) blob to the file `fn`.
+    """
+    storage.open_backend(path).get_to_file(blob_key(hexdigest), fn)
+
+
+def manifest_dir(path):
+    return join(store_location(path), 'manifests')
+
+
+def manifest_key(name):
+    return 'manifests/{}.json'.format(name)
+
+
+def has_manifest(path, name):
+    return storage.open_backend(path).exists(manifest_key(name))
+
+
+def write_manifest(path, name, html, source_hash, images):
+    """
+    records a snapshot.
+
+    `html` is the hex key of its html blob, `source_hash` is the hash of its text (see `uwecscraper.source_hash_of_text`),
+    and `images` is a dict from image filename to hex key.
+    """
+    manifest = {'name': name, 'html': html, 'source_hash': source_hash.hex(), 'images': images}
+    storage.open_backend(path).put(manifest_key(name), json.dumps(manifest, indent=1).encode('utf-8'))
+
+
+def read_manifest(path, name):
+    manifest = json.loads(storage.open_backend(path).get(manifest_key(name)).decode('utf-8'))
+    manifest['source_hash'] = bytes.fromhex(manifest['source_hash'])
+    return manifest
+
+
+def snapshot_names(path):
+    """
+    the names of all snapshots in the store, sorted.
+    """
+    keys = storage.open_backend(path).list('manifests/')
+    return sorted(k[len('manifests/'):-5] for k in keys if k.endswith('.json'))
+
+
+def save_snapshot(path, name, text, source_hash, image_folder = None, img_hashes = None, move = False):
+    """
+    puts a snapshot into the store: its html `text`, and the png's in `image_folder`, if any.
+
+    `img_hashes` (a dict from image filename to digest) saves hashing the images again.
+    with `move`, the images are moved into the store rather than copied.
+    the manifest is written last, so a snapshot is never listed before all of its blobs are there.
+    """
+    html = put_bytes(path, text.encode('utf-8'), compress=True)
+
+    images = {}
+    if image_folder is not None:
+        imgs = [img for img in sorted(listdir(image_folder)) if isfile(join(image_folder, img)) and img.find('.png')>=0]
+        known = [img_hashes.get(img) if img_hashes is not None else None for img in imgs]
+        hexdigests = put_files(path, [(join(image_folder, img), k.hex() if k is not None else None) for img, k in zip(imgs, known)], move)
+        images = dict(zip(imgs, hexdigests))
+
+    write_manifest(path, name, html, source_hash, images)
+    return images
+
+
+def migrate(path, hash_soup, remove_old = False, store = None):
+    """
+    moves an archive of `<iso>_N.html` files and `<iso>_Nimgs/` folders into a store.
+
+    `hash_soup` is a function from html text to the source hash recorded in the manifest
+    (pass `uwecscraper.source_hash_of_text`).  snapshots already in the store are skipped,
+    so this can be re-run.  with `remove_old`, the html files and image folders are deleted
+    as they're migrated.
+
+    the store is made in place, unless `store` gives another location (like an `s3://bucket/prefix`).
+    """
+    if store is None:
+        store = path
+    init(store)
+    done = set(snapshot_names(store))
+
+    htmlfiles = sorted(f for f in listdir(path) if isfile(join(path, f)) and f.endswith('.html'))
+    for f in htmlfiles:
+        name = f[:-5]
+        img_folder = join(path, name+'imgs')
+        if name not in done:
+            with open(join(path, f), 'r', encoding='utf-8') as fin:
+                text = fin.read()
+            save_snapshot(store, name, text, hash_soup(text), img_folder if isdir(img_folder) else None)
+            print('migrated {}'.format(name))
+
+        if remove_old:
+            os.remove(join(path, f))
+            if isdir(img_folder):
+                shutil.rmtree(img_folder)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+http helpers for the scraper.
+
+one shared, keep-alive `requests.Session`, with retries,
+and a thread pool for fetching a bunch of urls at once (the tableau images),
+so a poll takes about as long as the slowest image, rather than the sum of them.
+"""
+
+import hashlib
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+
+default_timeout = 30 # seconds, per request
+default_workers = 6 # max simultaneous downloads
+default_retries = 3
+chunk_size = 64*1024
+
+_session = None
+
+
+def make_session(workers = default_workers, retries = default_retries, hosts = None):
+    """
+    makes a session whose connection pool is big enough for `workers` threads,
+    and which retries failed connections and 5xx responses, backing off between tries.
+    `hosts` is how many hosts to keep connections open to; by default, `workers`.
+    """
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=hosts if hosts is not None else workers, pool_maxsize=workers, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    the shared session, made on first use.
+    """
+    global _session
+    if _session is None:
+        _session = make_session()
+    return _session
+
+
+def use_session(session):
+    """
+    makes `session` the shared one, say, one made with a bigger pool for polling many dashboards.
+    """
+    global _session
+    _session = session
+
+
+def conditional_headers(cached = None):
+    """
+    request headers asking for the body only if it changed since `cached` was fetched.
+
+    `cached` is a dict with the `etag` and `last_modified` from the earlier response, or `None`.
+    """
+    headers = {}
+    if cached is None:
+        return headers
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    return headers
+
+
+def get(url, session = None, timeout = default_timeout, headers = None, stream = False):
+    if session is None:
+        session = get_session()
+    return session.get(url, timeout=timeout, headers=headers, stream=stream)
+
+
+def fetch_to_file(url, fn, session = None, timeout = default_timeout, headers = None, stats = None):
+    """
+    downloads `url`, streaming the body to the file `fn` in chunks,
+    and computing its sha256 on the way through.
+
+    nothing is written if the server says 304 not modified, or if `fn` is `None`
+    (the body is still hashed, in the latter case).
+    returns `(response, digest)`.  the digest is `None` for a 304.
+
+    if `stats` (a `poll_stats.PollStats`) is given, the bytes and responses are counted in it.
+    """
+    with get(url, session, timeout, headers, stream=True) as r:
+        if stats is not None:
+            stats.count('requests')
+        if r.status_code==304:
+            if stats is not None:
+                stats.count('not_modified')
+            return r, None
+
+        n = hashlib.sha256()
+        fout = open(fn, "wb") if fn is not None else None
+        try:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                n.update(chunk)
+                if stats is not None:
+                    stats.count('bytes_downloaded', len(chunk))
+                if fout is not None:
+                    fout.write(chunk)
+        finally:
+            if fout is not None:
+                fout.close()
+    return r, n.digest()
+
+
+def fetch_all(jobs, session = None, workers = default_workers, timeout = default_timeout, stats = None):
+    """
+    runs `fetch_to_file` for each `(url, fn)` or `(url, fn, headers)` in `jobs`,
+    at most `workers` at a time.
+
+    returns the `(response, digest)` pairs, in the order of `jobs`, once they're all done.
+    if any of them failed, raises the first failure.
+    """
+    jobs = [tuple(j) + (None,)*(3-len(j)) for j in jobs]
+    if session is None:
+        session = get_session()
+    if len(jobs)==0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        futures = [pool.submit(fetch_to_file, url, fn, session, timeout, headers, stats) for url, fn, headers in jobs]
+        return [f.result() for f in futures]
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+a small on-disk index of the content hashes of saved snapshots.
+
+`uwecscraper.save_html` records the hashes of the soup and images it writes,
+so that checking whether a freshly gathered page is new is a lookup here,
+rather than re-reading and re-hashing the archive.
+
+it also keeps a pointer to the newest snapshot, and the highest `_N` counter used for each timestamp,
+so finding the latest snapshot and naming a new one don't need a listing of the archive.
+
+the index is a sqlite file, kept in a folder for the archive under `meta_root`, on local disk,
+and outside the data location, which may be synced or in an object store.
+only the standard library is used, on purpose -- this is on the poll path.
+"""
+
+import os
+import re
+import json
+import shutil
+import sqlite3
+import threading
+from os.path import join
+
+# where the bookkeeping for every archive is kept: the index, caches and status files, one folder per archive.
+# it's outside the archives, so sqlite's journal files and the temp files of atomic writes never churn
+# a synced (Dropbox) folder, and so archives in an object store (`s3://...`) have it on local disk.
+# set the UWEC_SCRAPER_META environment variable to put it somewhere else.
+meta_root = os.environ.get('UWEC_SCRAPER_META') or join(os.path.expanduser('~'), '.cache', 'uwecscraper')
+
+# archives whose old in-archive bookkeeping folder has been looked for, this session.
+_picked_up = set()
+
+# open connections, one per archive per thread, so that a long-running poller keeps the index warm.
+_connections = threading.local()
+
+
+def meta_location(path):
+    """
+    the folder, named for `path`, under `meta_root`, in which the index (and other bookkeeping) lives.
+
+    a local archive's bookkeeping used to be in a hidden `.scraper` folder inside it.
+    if that's still there, and there's nothing under `meta_root` yet, it's moved over, the first time it's asked for.
+    """
+    remote = path.startswith('s3://')
+    loc = join(meta_root, re.sub('[^A-Za-z0-9._-]+', '_', path if remote else os.path.abspath(path)))
+    if not remote and loc not in _picked_up:
+        _picked_up.add(loc)
+        _pick_up_old_meta(join(path, '.scraper'), loc)
+    return loc
+
+
+def _pick_up_old_meta(old, loc):
+    if not os.path.isdir(old) or os.path.exists(loc):
+        return
+    os.makedirs(os.path.dirname(loc), exist_ok=True)
+    try:
+        shutil.move(old, loc)
+    except OSError:
+        if not os.path.exists(loc): # not just another process moving it first
+            raise
+
+
+def index_location(path):
+    return join(meta_location(path), 'hash_index.sqlite')
+
+
+def connect(path):
+    """
+    opens (and if necessary creates) the hash index for the archive at `path`.
+    
+    connections are kept open and reused, per thread.
+    """
+    loc = index_location(path)
+    if not hasattr(_connections, 'open'):
+        _connections.open = {}
+    if loc in _connections.open:
+        return _connections.open[loc]
+    
+    os.makedirs(meta_location(path), exist_ok=True)
+    conn = sqlite3.connect(loc)
+    conn.execute("""CREATE TABLE IF NOT EXISTS snapshots (
+                        name TEXT PRIMARY KEY,
+                        source_hash BLOB,
+                        region_hash BLOB)""")
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(snapshots)")]
+    if 'region_hash' not in columns: # an index from before region hashes
+        conn.execute("ALTER TABLE snapshots ADD COLUMN region_hash BLOB")
+    conn.execute("""CREATE TABLE IF NOT EXISTS images (
+                        snapshot TEXT,
+                        img_name TEXT,
+                        digest BLOB,
+                        PRIMARY KEY (snapshot, img_name))""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS http_cache (
+                        url TEXT PRIMARY KEY,
+                        etag TEXT,
+                        last_modified TEXT,
+                        digest BLOB,
+                        links TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS name_counters (
+                        stem TEXT PRIMARY KEY,
+                        highest INTEGER)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+                        key TEXT PRIMARY KEY,
+                        value TEXT)""")
+    _connections.open[loc] = conn
+    return conn
+
+
+def close(path):
+    """
+    closes this thread's connection to the index for `path`, if it's open.
+    """
+    loc = index_location(path)
+    conn = getattr(_connections, 'open', {}).pop(loc, None)
+    if conn is not None:
+        conn.close()
+    
+
+def record_snapshot(path, name, source_hash, img_hashes, region_hash = None):
+    """
+    records the hashes for one saved snapshot.
+
+    `name` is the snapshot name, the html filename without `.html`, like `2020-09-25T10.00.00_0`.
+    `img_hashes` is a dict from image filename to digest.
+    `region_hash` is the hash of just the data-bearing parts of the page, if known.
+    """
+    conn = connect(path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO snapshots (name, source_hash, region_hash) VALUES (?,?,?)",
+                     (name, source_hash, region_hash))
+        conn.execute("DELETE FROM images WHERE snapshot=?", (name,))
+        conn.executemany("INSERT INTO images VALUES (?,?,?)",
+                         [(name, img, digest) for img, digest in img_hashes.items()])
+        _note_name(conn, name)
+
+
+def _split_name(name):
+    """
+    `2020-09-25T10.00.00_3` -> `('2020-09-25T10.00.00', 3)`.  `None` for a name without a counter.
+    """
+    stem, _, counter = name.rpartition('_')
+    if stem=='' or not counter.isdigit():
+        return None
+    return stem, int(counter)
+
+
+def _note_name(conn, name):
+    """
+    moves the latest pointer and the counter for its timestamp forward to `name`, if it's past them.
+    call inside a transaction.
+    """
+    conn.execute("""INSERT INTO meta VALUES ('latest', ?)
+                    ON CONFLICT(key) DO UPDATE SET value=excluded.value WHERE excluded.value > value""", (name,))
+    split = _split_name(name)
+    if split is not None:
+        conn.execute("""INSERT INTO name_counters VALUES (?,?)
+                        ON CONFLICT(stem) DO UPDATE SET highest=excluded.highest WHERE excluded.highest > highest""", split)
+
+
+def latest_name(path):
+    """
+    the name of the newest snapshot saved, per the pointer, or `None` if it isn't set.
+    """
+    row = connect(path).execute("SELECT value FROM meta WHERE key='latest'").fetchone()
+    return row[0] if row is not None else None
+
+
+def rebuild_names(path, names):
+    """
+    resets the latest pointer and the counters from `names`, the snapshots actually in the archive.
+    this is the fallback, for when the pointer or counters are missing or wrong.
+    the hashes of snapshots no longer in the archive (deleted by hand, say) are dropped too.
+    """
+    conn = connect(path)
+    present = set(names)
+    gone = [(name,) for (name,) in conn.execute("SELECT name FROM snapshots") if name not in present]
+    with conn:
+        conn.executemany("DELETE FROM snapshots WHERE name=?", gone)
+        conn.executemany("DELETE FROM images WHERE snapshot=?", gone)
+        conn.execute("DELETE FROM meta WHERE key IN ('latest', 'counters_built')")
+        conn.execute("DELETE FROM name_counters")
+        for name in names:
+            _note_name(conn, name)
+        conn.execute("INSERT INTO meta VALUES ('counters_built', '1')")
+
+
+def next_counter(path, stem, scan):
+    """
+    claims the next `_N` counter for the timestamp `stem`, and returns it.  0 for a timestamp not seen before.
+
+    the claim is made in one transaction, so two savers never get the same counter.
+    `scan` is a function returning the names of all the snapshots in the archive.
+    it's only called the first time, to build the counters for an archive the index hasn't seen them for.
+    """
+    conn = connect(path)
+    if conn.execute("SELECT value FROM meta WHERE key='counters_built'").fetchone() is None:
+        rebuild_names(path, scan())
+    with conn:
+        conn.execute("""INSERT INTO name_counters VALUES (?, 0)
+                        ON CONFLICT(stem) DO UPDATE SET highest=highest+1""", (stem,))
+        return conn.execute("SELECT highest FROM name_counters WHERE stem=?", (stem,)).fetchone()[0]
+
+
+def snapshot(path, name):
+    """
+    returns `(name, source_hash, img_hashes, region_hash)` for the snapshot `name`,
+    or `None` if it isn't in the index.  region_hash may be `None`.
+    """
+    conn = connect(path)
+    row = conn.execute("SELECT source_hash, region_hash FROM snapshots WHERE name=?", (name,)).fetchone()
+    if row is None:
+        return None
+
+    source_hash, region_hash = row
+    img_hashes = dict(conn.execute("SELECT img_name, digest FROM images WHERE snapshot=?", (name,)).fetchall())
+    return name, source_hash, img_hashes, region_hash
+
+
+def latest_snapshot(path):
+    """
+    `snapshot` for the newest snapshot, as the latest pointer has it (see `latest_name`),
+    or `None` if the pointer isn't set, or that snapshot isn't indexed.
+    """
+    name = latest_name(path)
+    return snapshot(path, name) if name is not None else None
+
+
+def get_http_cache(path, url):
+    """
+    the validators (`etag`, `last_modified`), body `digest`, and tableau image `links`
+    (for pages) from the last time `url` was fetched and processed, as a dict.
+    `None` if we've never seen it.
+    """
+    conn = connect(path)
+    row = conn.execute("SELECT url, etag, last_modified, digest, links FROM http_cache WHERE url=?", (url,)).fetchone()
+    if row is None:
+        return None
+    return {'url': row[0], 'etag': row[1], 'last_modified': row[2], 'digest': row[3],
+            'links': json.loads(row[4]) if row[4] is not None else []}
+
+
+def record_http_cache(path, entries):
+    """
+    stores a list of dicts like those returned by `get_http_cache`.
+    """
+    conn = connect(path)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO http_cache VALUES (?,?,?,?,?)",
+                         [(e['url'], e.get('etag'), e.get('last_modified'), e.get('digest'),
+                           json.dumps(e.get('links', []))) for e in entries])
@@ -17,56 +17,291 @@ def daily_numbers(im, report = False, from_file = False):
     # Then trim the string 
     if from_file:
         im = Image.open(im)
+    elif hasattr(im, 'as_image'): # a lazy handle, like uwecscraper.ImageHandle
+        im = im.as_image()
         
     numbers = im.crop(daily_numbers_box)
     num_gs = gs(numbers)
     text = pt.image_to_string(num_gs)
 
-    # Trim "%", newlines, etc from end
-    # - Then remove commas from numbers
-    # - Then 
-    cstext = text[:text.index("%")]
-    cstext = cstext.replace(",", "") # remove commas from numbers (e.g. 1,234 ~~> 1234)
-    vals = cstext.split(" ")
-    vals[0] = int(vals[0])
-    vals[1] = int(vals[1])
-    vals[2] = float(vals[2])
+    vals = parse_daily_numbers(text)
     if report:
         print("Daily numbers:")
         print("Positive tests: {}\nTotal tests: {}\n Percent positive: {}\n".format(vals[0], vals[1], vals[2]))
 
     return vals
 
+# Trim "%", newlines, etc from end
+# - Then remove commas from numbers
+# - Then split into [positives, tests, percent]
+# Raises ValueError if the text doesn't read as three numbers and a %.
+def parse_daily_numbers(text):
+    cstext = text[:text.index("%")]
+    cstext = cstext.replace(",", "") # remove commas from numbers (e.g. 1,234 ~~> 1234)
+    vals = cstext.split()
+    if len(vals) < 3:
+        raise ValueError("expected 3 numbers, read {!r}".format(text))
+    return [int(vals[0]), int(vals[1]), float(vals[2])]
+
+# Batched OCR.  Each tesseract call is a new process, and starting it costs more than reading
+# one small crop, so many crops are stacked into one tall image, with white space between them,
+# and read with a single call.  Each word tesseract finds is put back with its tile by where it is vertically.
+# Recognition is restricted to what the numbers can contain; "." for the decimal point of the percent.
+batch_config = "--psm 6 -c tessedit_char_whitelist=0123456789,.%"
+batch_size = 40 # crops per tesseract call
+batch_gap = 40 # pixels of white between stacked crops
+
+# ims is a list of images (or filenames, or lazy handles, as for daily_numbers).
+# Returns (results, calls): a list of (positives, tests, percent) tuples, or None for any that couldn't be read,
+# and the number of tesseract calls made.
+# Crops whose stacked reading doesn't parse are retried on their own, with daily_numbers,
+# as are all of them if tesseract fails on the stack.  An image that can't be opened
+# or cropped (a truncated png, say) is None, and doesn't spoil the rest of the batch.
+def batch_read_numbers(ims):
+    if len(ims) == 0:
+        return [], 0
+
+    opened = [None]*len(ims)
+    crops = {}
+    for ii, im in enumerate(ims):
+        try:
+            if isinstance(im, str):
+                im = Image.open(im)
+            elif hasattr(im, 'as_image'):
+                im = im.as_image()
+            crops[ii] = gs(im.crop(daily_numbers_box))
+            opened[ii] = im
+        except Exception as e:
+            print("couldn't open {}: {}".format(ims[ii], e))
+
+    calls = 0
+    words = {ii: None for ii in crops}
+    if len(crops) > 0:
+        width = max(c.width for c in crops.values())
+        stride = max(c.height for c in crops.values()) + batch_gap
+        stacked = Image.new("L", (width, stride*len(crops)), 255)
+        order = sorted(crops)
+        for jj, ii in enumerate(order):
+            stacked.paste(crops[ii], (0, jj*stride + batch_gap//2))
+
+        calls += 1
+        try:
+            data = pt.image_to_data(stacked, config=batch_config, output_type=pt.Output.DICT)
+        except pt.TesseractError as e:
+            print("tesseract failed on a batch of {}, reading them one at a time: {}".format(len(order), e))
+        else:
+            words = {ii: [] for ii in crops}
+            for text, top, height in zip(data["text"], data["top"], data["height"]):
+                if text.strip() == "":
+                    continue
+                jj = min(len(order)-1, (top + height//2) // stride)
+                words[order[jj]].append(text.strip())
+
+    results = [None]*len(ims)
+    for ii, w in words.items():
+        vals = None
+        if w is not None:
+            try:
+                vals = parse_daily_numbers(" ".join(w))
+            except ValueError:
+                pass
+        if vals is None:
+            calls += 1
+            try:
+                vals = daily_numbers(opened[ii])
+            except (ValueError, pt.TesseractError):
+                vals = None
+        results[ii] = tuple(vals) if vals is not None else None
+    return results, calls
+
+# OCR for lots of images at once, e.g. over the whole archive.
+# The answer for an image never changes, so results are cached on disk,
+# keyed by the image's sha256 (and the cropping box and settings), and only new images get OCR'd.
+# Unreadable numbers are an answer too (None), so they get cached and not retried.
+def _open_ocr_cache(cache_file):
+    import sqlite3
+    conn = sqlite3.connect(cache_file)
+    conn.execute("""CREATE TABLE IF NOT EXISTS daily_numbers (
+                        digest BLOB,
+                        box TEXT,
+                        vals TEXT,
+                        PRIMARY KEY (digest, box))""")
+    return conn
+
+# images is a list of (sha256 digest, filename or image handle) pairs.
+# Returns a list of the same length, of (positives, tests, percent) or None if unreadable.
+# The images not in the cache are read batch_size at a time with batch_read_numbers,
+# one tesseract call per batch (plus one per crop it has to retry), with the batches spread over a process pool.
+# Each batch's results are put in the cache as it finishes, so an interrupted run keeps what it read.
+# If stats is a dict, the number of cache hits, of images OCR'd and of tesseract calls are put in it.
+def batch_daily_numbers(images, cache_file = None, workers = None, stats = None):
+    import json
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    # The results depend on the crop and on the tesseract settings
+    box = json.dumps([daily_numbers_box, batch_config])
+    results = [None]*len(images)
+    todo = list(range(len(images)))
+
+    conn = None
+    if cache_file is not None:
+        conn = _open_ocr_cache(cache_file)
+        todo = []
+        for ii, (digest, fn) in enumerate(images):
+            row = conn.execute("SELECT vals FROM daily_numbers WHERE digest=? AND box=?", (digest, box)).fetchone()
+            if row is None:
+                todo.append(ii)
+            else:
+                results[ii] = json.loads(row[0])
+
+    batches = [todo[jj:jj+batch_size] for jj in range(0, len(todo), batch_size)]
+    calls = 0
+    try:
+        if len(batches)>0:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = {pool.submit(batch_read_numbers, [images[ii][1] for ii in batch]): batch for batch in batches}
+                for future in as_completed(pending):
+                    batch = pending[future]
+                    vals, n = future.result()
+                    calls += n
+                    for ii, v in zip(batch, vals):
+                        results[ii] = v
+                    if conn is not None:
+                        with conn:
+                            conn.executemany("INSERT OR REPLACE INTO daily_numbers VALUES (?,?,?)",
+                                             [(images[ii][0], box, json.dumps(results[ii])) for ii in batch])
+    finally:
+        if conn is not None:
+            conn.close()
+
+    results = [tuple(v) if v is not None else None for v in results]
+    if stats is not None:
+        stats['cached'] = len(images) - len(todo)
+        stats['ocrd'] = len(todo)
+        stats['tesseract_calls'] = calls
+
+    return results
+
+# The time series table, data/table.csv
+# Columns: date, daily_pos, daily_tests, daily_pcnt, cumul_pos, cumul_test
+# Date stored as "YYYY-mm-dd" aka isoformat
+table_columns = ["date", "daily_pos", "daily_tests", "daily_pcnt", "cumul_pos", "cumul_test"]
+
+# Reads just the last row of the table, by seeking back from the end of the file,
+# so appending doesn't cost more as the table grows.
+# Returns a dict of column name -> string, or None if the table has no rows.
+def _last_row(tableCSV):
+    import csv
+    import os
+
+    with open(tableCSV, "rb") as fin:
+        header = fin.readline()
+        end = fin.seek(0, os.SEEK_END)
+        # Read backwards a KB at a time, until we've got the whole last line
+        chunk = b""
+        pos = end
+        while pos > len(header) and b"\n" not in chunk.rstrip(b"\r\n"):
+            pos = max(len(header), pos - 1024)
+            fin.seek(pos)
+            chunk = fin.read(end - pos)
+    lines = [l for l in chunk.decode("utf-8").splitlines() if l.strip() != ""]
+    if len(lines) == 0:
+        return None
+    return dict(zip(next(csv.reader([header.decode("utf-8")])), next(csv.reader([lines[-1]]))))
+
 # data should be a list-like containing (new cases, new tests, percentage)
 # percentage is actually re-calculated here
-def add_new_data(data, tableCSV):
-    import pandas as pd
+# day is a datetime.date, defaulting to today.
+# Each day is entered once: if the table already ends with this day, nothing is added,
+# unless allow_same_date (as on 2020-09-14, which had two updates).
+def add_new_data(data, tableCSV, day = None, allow_same_date = False):
+    import csv
     from datetime import date
 
-    # Read in stored table of covid data
-    # Columns: date, daily_pos, daily_tests, daily_pcnt, cumul_pos, cumul_test
-    covidDF = pd.read_csv(tableCSV)
-    # Date stored as "YYYY-mm-dd" aka isoformat
-    today = date.today().isoformat()
+    if day is None:
+        day = date.today()
+    day = day.isoformat()
 
     # Convert to int; we will re-calculate percentage
     data = [int(d) for d in data]
     percent = round(100*data[0]/data[1], 1)
 
-    cumul_pos = covidDF.cumul_pos.iloc[-1] + data[0]
-    cumul_test = covidDF.cumul_test.iloc[-1] + data[1]
+    last = _last_row(tableCSV)
+    if last is not None and last["date"] == day and not allow_same_date:
+        print("table already has a row for {}, not adding another".format(day))
+        return
+
+    cumul_pos = (int(last["cumul_pos"]) if last is not None else 0) + data[0]
+    cumul_test = (int(last["cumul_test"]) if last is not None else 0) + data[1]
+
+    # Append just the new row, rather than rewriting the whole table
+    needs_newline = False
+    with open(tableCSV, "rb") as fin:
+        if fin.seek(0, 2) > 0:
+            fin.seek(-1, 2)
+            needs_newline = fin.read(1) != b"\n"
+    with open(tableCSV, "a", newline="") as fout:
+        if needs_newline:
+            fout.write("\n")
+        csv.writer(fout, lineterminator="\n").writerow([day, data[0], data[1], percent, cumul_pos, cumul_test])
+
+# Builds the whole table in one go, from a DataFrame with date, daily_pos and daily_tests columns,
+# one row per day.  The percentages and running totals are computed vectorized.
+# start_pos and start_test are the totals from before the first day
+# (for our table, 9 positives from 43 tests before 2020-09-04).
+def build_table(daily, tableCSV, start_pos = 0, start_test = 0):
+    import pandas as pd
+
+    covidDF = pd.DataFrame({
+        "date": pd.to_datetime(daily["date"]).dt.strftime("%Y-%m-%d").values,
+        "daily_pos": daily["daily_pos"].astype(int).values,
+        "daily_tests": daily["daily_tests"].astype(int).values,
+        })
+    covidDF = recompute_totals(covidDF, start_pos, start_test)
+
+    covidDF[table_columns].to_csv(tableCSV, index=False)
+    return covidDF
+
+# The daily columns are the truth; daily_pcnt, cumul_pos and cumul_test are derived from them.
+# This re-derives them, vectorized, so a corrected or removed day fixes every later row.
+# start_pos and start_test are the totals from before the first row; if not given,
+# they're inferred from the first row as it stands.
+def recompute_totals(covidDF, start_pos = None, start_test = None):
+    covidDF = covidDF.copy()
+    if start_pos is None:
+        start_pos = covidDF.cumul_pos.iloc[0] - covidDF.daily_pos.iloc[0] if len(covidDF) > 0 else 0
+    if start_test is None:
+        start_test = covidDF.cumul_test.iloc[0] - covidDF.daily_tests.iloc[0] if len(covidDF) > 0 else 0
+
+    covidDF["daily_pcnt"] = (100*covidDF.daily_pos/covidDF.daily_tests).round(1)
+    covidDF["cumul_pos"] = start_pos + covidDF.daily_pos.cumsum()
+    covidDF["cumul_test"] = start_test + covidDF.daily_tests.cumsum()
+    return covidDF
+
+# Re-derives the percentages and running totals of the whole table, in place.
+def recompute_table(tableCSV, start_pos = None, start_test = None):
+    import pandas as pd
+
+    covidDF = recompute_totals(pd.read_csv(tableCSV), start_pos, start_test)
+    covidDF[table_columns].to_csv(tableCSV, index=False)
+    return covidDF
+
+# After editing the daily numbers of a day (a datetime.date or "YYYY-mm-dd"), by hand or by backfill,
+# this brings the derived columns of that day and every later one up to date.
+# Rows before it are left alone; the totals carry on from the row just before.
+def update_table_from(tableCSV, day):
+    import pandas as pd
+
+    covidDF = pd.read_csv(tableCSV)
+    day = day if isinstance(day, str) else day.isoformat()
 
-    # Easy to append row from dictionary. 
-    # Complains unless values are lists
-    new_data = {
-        "date": [today],
-        "daily_pos": [data[0]],
-        "daily_tests": [data[1]],
-        "daily_pcnt": [percent],
-        "cumul_pos": [cumul_pos],
-        "cumul_test": [cumul_test]
-        }
+    first = int((covidDF.date < day).sum())
+    if first == 0:
+        return recompute_table(tableCSV)
 
-    covidDF = covidDF.append(pd.DataFrame(new_data), ignore_index = True)
+    before = covidDF.iloc[first-1]
+    after = recompute_totals(covidDF.iloc[first:], before.cumul_pos, before.cumul_test)
+    covidDF.iloc[first:] = after[covidDF.columns]
 
-    covidDF.to_csv(tableCSV, index=False)
+    covidDF[table_columns].to_csv(tableCSV, index=False)
+    return covidDF
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+timings and counters for one poll of the dashboard.
+
+`uwecscraper.gather_and_save` makes one of these per run, times each stage with `stage`,
+counts bytes and images with `count`, and at the end emits it as one json line
+(and optionally a prometheus textfile, for node_exporter's textfile collector).
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class PollStats:
+    """
+    the stages and counters of one poll.  `count` is safe to call from the download threads.
+    """
+
+    def __init__(self, target = None):
+        self.target = target
+        self.started = time.time()
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.outcome = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        times the body of the `with` block, adding it to the stage `name`.
+        """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - t
+
+    def count(self, name, n = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def as_dict(self):
+        return {'time': self.started, 'target': self.target, 'outcome': self.outcome,
+                'duration': round(time.time() - self.started, 6),
+                'stages': {k: round(v, 6) for k, v in self.stages.items()},
+                'counters': dict(self.counters)}
+
+    def emit(self, log_file = None, prom_file = None):
+        """
+        prints the stats as one json line, and appends it to `log_file`, if given.
+        if `prom_file` is given, (over)writes it with the stats in prometheus text format.
+        """
+        line = json.dumps(self.as_dict(), sort_keys=True)
+        print(line)
+        if log_file is not None:
+            with open(log_file, 'a', encoding='utf-8') as fout:
+                fout.write(line + '\n')
+        if prom_file is not None:
+            write_prometheus(self, prom_file)
+
+
+def stage(stats, name):
+    """
+    `stats.stage(name)`, or a do-nothing context if `stats` is `None`,
+    for functions where the stats are optional.
+    """
+    if stats is None:
+        return nullcontext()
+    return stats.stage(name)
+
+
+def write_prometheus(stats, prom_file):
+    """
+    writes the stats as gauges, atomically, so the collector never reads half a file.
+    """
+    labels = 'target="{}"'.format(stats.target) if stats.target is not None else ''
+    lines = ['# TYPE uwec_poll_last_timestamp_seconds gauge',
+             'uwec_poll_last_timestamp_seconds{{{}}} {}'.format(labels, stats.started),
+             '# TYPE uwec_poll_duration_seconds gauge',
+             'uwec_poll_duration_seconds{{{}}} {}'.format(labels, time.time() - stats.started),
+             '# TYPE uwec_poll_stage_seconds gauge']
+    sep = ',' if labels else ''
+    for name, seconds in sorted(stats.stages.items()):
+        lines.append('uwec_poll_stage_seconds{{{}{}stage="{}"}} {}'.format(labels, sep, name, seconds))
+    for name, n in sorted(stats.counters.items()):
+        lines.append('# TYPE uwec_poll_{} gauge'.format(name))
+        lines.append('uwec_poll_{}{{{}}} {}'.format(name, labels, n))
+    lines.append('# TYPE uwec_poll_outcome gauge')
+    lines.append('uwec_poll_outcome{{{}{}outcome="{}"}} 1'.format(labels, sep, stats.outcome))
+
+    tmp = prom_file + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as fout:
+        fout.write('\n'.join(lines) + '\n')
+    os.replace(tmp, prom_file)
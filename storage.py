@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+where an archive in store mode keeps its blobs and manifests (see `blob_store`).
+
+two backends, with the same few methods, over '/'-separated keys like `blobs/ab/abcdef...`:
+
+- `LocalBackend`, a folder.  writes are atomic, via temp files named `~<name>.tmp`,
+  which Dropbox (and most sync clients) ignore, so a synced archive only ever syncs finished files.
+- `S3Backend`, a bucket in any s3-compatible object store (aws, minio, ...).
+  needs `boto3`, which is only imported if one is used.
+
+`open_backend` picks one from the archive location: `s3://bucket/prefix` for s3, anything else is a folder.
+the endpoint and credentials come from the usual boto3 environment variables
+(`AWS_ENDPOINT_URL` to point it at a minio), or make an `S3Backend` yourself and `register_backend` it.
+
+an archive in the plain layout -- `<iso>_N.html` files and `<iso>_Nimgs/` folders, not a store --
+is read and written through `open_folder`, a `LocalBackend` on the data location itself,
+so its writes get the same atomic, sync-friendly temp files.
+"""
+
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, isfile, isdir
+
+default_workers = 8 # simultaneous requests, for the batched operations on s3
+
+_backends = {}
+
+
+def is_remote(location):
+    return location.startswith('s3://')
+
+
+def register_backend(location, backend):
+    """
+    makes `open_backend(location)` return `backend`.
+    """
+    _backends[location] = backend
+
+
+def open_folder(location):
+    """
+    the backend for an archive in the plain layout, rooted at the data location `location` itself.
+    """
+    key = ('folder', location)
+    if key not in _backends:
+        _backends[key] = LocalBackend(location)
+    return _backends[key]
+
+
+def open_backend(location):
+    """
+    the backend for the archive at `location`, made on first use.
+    for a folder, the store is its `store` subfolder.
+    """
+    if location not in _backends:
+        if is_remote(location):
+            bucket, _, prefix = location[len('s3://'):].partition('/')
+            _backends[location] = S3Backend(bucket, prefix)
+        else:
+            _backends[location] = LocalBackend(join(location, 'store'))
+    return _backends[location]
+
+
+class LocalBackend:
+    """
+    keys are paths under the folder `root`.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def __repr__(self):
+        return 'LocalBackend({!r})'.format(self.root)
+
+    def local_path(self, key):
+        """
+        the file for `key`, which can be opened directly.
+        """
+        return join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return isfile(self.local_path(key))
+
+    def has_folder(self, prefix):
+        """
+        whether there's a folder `prefix`, like `2020-09-25T10.00.00_0imgs/`, even an empty one.
+        """
+        return isdir(self.local_path(prefix.rstrip('/')))
+
+    def _temp_for(self, fn):
+        return join(os.path.dirname(fn), '~{}.{}.tmp'.format(os.path.basename(fn), os.getpid()))
+
+    def put(self, key, data):
+        fn = self.local_path(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmp = self._temp_for(fn)
+        with open(tmp, 'wb') as fout:
+            fout.write(data)
+        os.replace(tmp, fn)
+
+    def put_many(self, items):
+        """
+        puts each `(key, data)` in `items`.
+        """
+        for key, data in items:
+            self.put(key, data)
+
+    def put_files(self, items, move = False):
+        """
+        puts the file `fn` of each `(key, fn)` in `items`, moving it if `move`.
+        a move from another filesystem is a copy to a temp file, like any other put, and then a delete.
+        """
+        for key, fn in items:
+            dest = self.local_path(key)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if move:
+                try:
+                    os.replace(fn, dest)
+                    continue
+                except OSError: # not on the same filesystem
+                    pass
+            tmp = self._temp_for(dest)
+            shutil.copyfile(fn, tmp)
+            os.replace(tmp, dest)
+            if move:
+                os.remove(fn)
+
+    def get(self, key):
+        with open(self.local_path(key), 'rb') as fin:
+            return fin.read()
+
+    def get_to_file(self, key, fn):
+        shutil.copyfile(self.local_path(key), fn)
+
+    def delete(self, key):
+        os.remove(self.local_path(key))
+
+    def list(self, prefix, recursive = True):
+        """
+        the keys starting with `prefix`, which should be a folder, like `manifests/`, or `''` for all of them.  sorted.
+        unless `recursive`, only those directly in that folder.
+        """
+        folder = self.local_path(prefix.rstrip('/'))
+        if not isdir(folder):
+            return []
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(folder):
+            rel = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            keys.extend((f if rel=='.' else '{}/{}'.format(rel, f)) for f in filenames if not f.startswith('~'))
+            if not recursive:
+                break
+        return sorted(keys)
+
+    def folders(self, prefix = ''):
+        """
+        the names of the folders directly in the folder `prefix` (by default, the top), sorted.
+        """
+        folder = self.local_path(prefix.rstrip('/'))
+        if not isdir(folder):
+            return []
+        return sorted(e.name for e in os.scandir(folder) if e.is_dir())
+
+
+class S3Backend:
+    """
+    keys are object keys under `prefix`, in `bucket`.
+    the batched operations run `workers` requests at a time, over one client.
+    """
+
+    def __init__(self, bucket, prefix = '', endpoint_url = None, workers = default_workers, client = None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.endpoint_url = endpoint_url
+        self.workers = workers
+        self._client = client
+
+    def __repr__(self):
+        return 'S3Backend({!r}, {!r})'.format(self.bucket, self.prefix)
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            from botocore.config import Config
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url,
+                                        config=Config(max_pool_connections=self.workers))
+        return self._client
+
+    def _object(self, key):
+        return '{}/{}'.format(self.prefix, key) if self.prefix else key
+
+    def local_path(self, key):
+        return None
+
+    def has_folder(self, prefix):
+        return len(self.client.list_objects_v2(Bucket=self.bucket, Prefix=self._object(prefix.rstrip('/')+'/'), MaxKeys=1).get('Contents', []))>0
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object(key))
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._object(key), Body=data)
+
+    def _each(self, fn, items):
+        items = list(items)
+        if len(items)==0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(items))) as pool:
+            return list(pool.map(lambda item: fn(*item), items))
+
+    def put_many(self, items):
+        self._each(self.put, items)
+
+    def put_files(self, items, move = False):
+        def put_file(key, fn):
+            self.client.upload_file(fn, self.bucket, self._object(key))
+            if move:
+                os.remove(fn)
+        self._each(put_file, items)
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self._object(key))['Body'].read()
+
+    def get_to_file(self, key, fn):
+        self.client.download_file(self.bucket, self._object(key), fn)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object(key))
+
+    def _pages(self, prefix, recursive = True):
+        kwargs = {} if recursive else {'Delimiter': '/'}
+        return self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self._object(prefix), **kwargs)
+
+    def list(self, prefix, recursive = True):
+        keys = []
+        skip = len(self.prefix)+1 if self.prefix else 0
+        for page in self._pages(prefix, recursive):
+            keys.extend(obj['Key'][skip:] for obj in page.get('Contents', []))
+        return sorted(keys)
+
+    def folders(self, prefix = ''):
+        prefix = prefix.rstrip('/')+'/' if prefix else ''
+        skip = len(self._object(prefix)) if self.prefix or prefix else 0
+        names = []
+        for page in self._pages(prefix, recursive=False):
+            names.extend(p['Prefix'][skip:].rstrip('/') for p in page.get('CommonPrefixes', []))
+        return sorted(names)
@@ -8,18 +8,23 @@ Created on Thu Sep 17 17:18:04 2020
 
 #%%
 
-import pandas as pd
+# only the light stuff is imported up here, so that a poll which finds nothing new
+# never loads pandas, numpy, bs4 or the ocr tools.  the functions that need them import them.
+# `benchmarks/importtime.py` checks that this stays true.
+
 import re
-import requests
 from datetime import datetime
-from bs4 import BeautifulSoup
 import hashlib
+import importlib.util
 import os
 from os import listdir
-from os.path import isfile, join, isdir
-import numpy as np
+from os.path import isfile, join
 
-import ocr_tools
+import hash_index
+import archive_cache
+import blob_store
+import fetching
+import storage
 
 os.environ['PATH'] += os.pathsep + '/usr/local/bin'
 
@@ -32,75 +37,255 @@ default_data_location = "/Users/amethyst/Dropbox/work/covid/data/daily_website_s
 
 
 
-def read_daily_source(path = default_data_location):
+class SoupHandle:
+    """
+    a saved page, not yet parsed: which snapshot it is, and its source hash (see `source_hash_of_text`).
+    
+    the html is only read and parsed the first time the soup is used, and the soup is kept as long as the handle.
+    anything a soup has works on the handle too, like `handle.find_all('td')`; `soup()` is the soup itself.
+    `get_hash` takes these directly, without parsing.
+    """
+    __slots__ = ('snapshot', 'path', 'digest', '_soup')
+    
+    def __init__(self, snapshot, path, digest):
+        self.snapshot = snapshot
+        self.path = path
+        self.digest = digest
+        self._soup = None
+    
+    def __repr__(self):
+        return 'SoupHandle({!r})'.format(self.snapshot)
+    
+    def __str__(self):
+        return str(self.soup())
+    
+    def __getstate__(self): # pickled without the soup, which is parsed again if it's needed
+        return self.snapshot, self.path, self.digest
+    
+    def __setstate__(self, state):
+        self.snapshot, self.path, self.digest = state
+        self._soup = None
+    
+    def __getattr__(self, attr):
+        if attr.startswith('_'): # not the soup's, and asked for before __init__ by copy and pickle
+            raise AttributeError(attr)
+        return getattr(self.soup(), attr)
+    
+    def soup(self):
+        if self._soup is None:
+            from bs4 import BeautifulSoup
+            try:
+                self._soup = BeautifulSoup(read_snapshot_text(self.snapshot, self.path), 'html.parser')
+            except Exception:
+                print('failed to read {}'.format(self.snapshot))
+                raise
+        return self._soup
+
+
+def read_daily_source(path = default_data_location, parse = True):
     """
     reads soup (but not images)
     into memory
     for all saved soups.
+    
+    the `source` column holds each page's `SoupHandle`, so a page is only parsed if its soup is used.
+    hashes are cached on disk (see `archive_cache`), so only files that are new or changed
+    since the last call get read at all.
+    the hash is of the file's text (see `source_hash_of_text`), so it matches the hash index and store manifests.
+    with `parse=False`, the `source` column is left empty.
     """
+    import pandas as pd
     
-    from os import listdir
-    from os.path import isfile, join
-    onlyfiles = [f for f in listdir(path) if isfile(join(path, f)) and f!='.DS_Store']
+    if blob_store.in_use(path):
+        return read_stored_source(path, parse)
+    
+    folder = storage.open_folder(path)
+    onlyfiles = [f for f in folder.list('', recursive=False) if f.endswith('.html')]
+    
+    cache = archive_cache.load(path)
+    cached_hashes = cache['source']
+    fresh_hashes = {}
     
     source = []
+    hashes = []
     for f in onlyfiles:
-        with open(join(path, f),'r',encoding='utf-8') as fin:
-            try:
-                source.append(BeautifulSoup(fin.read(), 'html.parser'))
-            except Exception:
-                print('failed to read {}'.format(f))
-                raise
+        key = archive_cache.file_key(folder.local_path(f))
+        h = archive_cache.lookup(cached_hashes, f, key)
+        
+        if h is None:
+            h = source_hash_of_text(folder.get(f).decode('utf-8'))
+        
+        fresh_hashes[f] = (key, h)
+        source.append(SoupHandle(f[:-5], path, h) if parse else None)
+        hashes.append(h)
     
-    data = pd.DataFrame({'name':onlyfiles, 'source':source})
+    if fresh_hashes!=cached_hashes:
+        cache['source'] = fresh_hashes
+        archive_cache.save(path, cache)
+    
+    data = pd.DataFrame({'name':onlyfiles, 'source':source, 'source_hash':hashes})
     data['name'] = data['name'].apply(lambda x: x[:-5])
-    data['source_hash'] = data['source'].apply(lambda x: get_hash(x))
     return data
 
+# store manifests never change, so once read they're kept for the session.
+_manifests = {}
+
+def read_stored_manifest(name, path = default_data_location):
+    key = (path, name)
+    if key not in _manifests:
+        _manifests[key] = blob_store.read_manifest(path, name)
+    return _manifests[key]
+
+
+def read_stored_source(path = default_data_location, parse = True):
+    """
+    `read_daily_source`, for an archive in store mode.  the hashes come from the manifests.
+    """
+    import pandas as pd
+    names = blob_store.snapshot_names(path)
+    hashes = [read_stored_manifest(n, path)['source_hash'] for n in names]
+    source = [SoupHandle(n, path, h) if parse else None for n, h in zip(names, hashes)]
+    return pd.DataFrame({'name':names, 'source':source, 'source_hash':hashes})
+
+
+def read_stored_images(path = default_data_location):
+    """
+    `read_daily_images`, for an archive in store mode.  the images are blobs, and the hashes come from the manifests.
+    """
+    import pandas as pd
+    names = []
+    images = []
+    hashes = []
+    for n in blob_store.snapshot_names(path):
+        manifest = read_stored_manifest(n, path)
+        if len(manifest['images'])==0:
+            continue
+        names.append(n)
+        images.append({img: ImageHandle(blob_store.blob_path(path, h), bytes.fromhex(h), path) for img, h in manifest['images'].items()})
+        hashes.append({img: bytes.fromhex(h) for img, h in manifest['images'].items()})
+    return pd.DataFrame({'name':names, 'images':images, 'img_hashes': hashes})
+
+
 def read_last_soup(path=default_data_location):
     """
     Reads in the latest html source as soup.
     """
-    from os import listdir
-    from os.path import isfile, join
-    htmlfiles = [f for f in listdir(path) if isfile(join(path, f)) and f!='.DS_Store' and f.find(".html")>=0]
-    htmlfiles.sort()
-    latest_name = htmlfiles[-1]
-    print(latest_name)
-    with open(join(path, latest_name),'r',encoding='utf-8') as fin:
-        soup = BeautifulSoup(fin.read(), 'html.parser')
-    return soup
+    from bs4 import BeautifulSoup
+    name = latest_snapshot_name(path)
+    if not blob_store.in_use(path):
+        print(name+'.html')
+    return BeautifulSoup(read_snapshot_text(name, path), 'html.parser')
+
+
+class ImageHandle:
+    """
+    a saved image, without its bytes in memory: just where it is, and its hash.
+    
+    the file is only opened when something needs its contents.
+    `get_hash` and `ocr_tools.daily_numbers` accept these directly.
+    
+    an image in a store that isn't on local disk has no `path`; it's fetched from the `store`
+    (the archive location), by its digest, when needed.
+    """
+    __slots__ = ('path', 'digest', 'store')
+    
+    def __init__(self, path, digest=None, store=None):
+        self.path = path
+        self.digest = digest
+        self.store = store
+    
+    def __repr__(self):
+        return 'ImageHandle({!r})'.format(self.path if self.path is not None else self.digest.hex())
+    
+    def hash(self):
+        if self.digest is None:
+            self.digest = hash_file(self.path)
+        return self.digest
+    
+    def read(self):
+        if self.path is None:
+            return blob_store.get_bytes(self.store, self.digest.hex())
+        with open(self.path,'rb') as fin:
+            return fin.read()
+    
+    def mmap(self):
+        """
+        the file, memory-mapped read-only.  close it when done.
+        only for images on local disk.
+        """
+        import mmap
+        with open(self.path,'rb') as fin:
+            return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def as_image(self):
+        """
+        opens the file as a PIL image.  PIL reads it lazily, too.
+        """
+        from PIL import Image
+        if self.path is None:
+            import io
+            return Image.open(io.BytesIO(self.read()))
+        return Image.open(self.path)
 
 
 def read_daily_images(path = default_data_location):
+    """
+    reads handles to the images, and their hashes, for all saved image folders.
+    
+    the `images` column holds dicts from image filename to `ImageHandle`, so no image is read into memory.
+    hashes are cached on disk (see `archive_cache`), so only images that are new or changed
+    since the last call get read at all.
+    """
+    import pandas as pd
+    if blob_store.in_use(path):
+        return read_stored_images(path)
+    
+    folder = storage.open_folder(path)
     img_folders = get_all_image_folders(path)
     
+    cache = archive_cache.load(path)
+    cached_hashes = cache['images']
+    fresh_hashes = {}
+    
     names = []
     images = []
     hashes = []
     for f in img_folders:
-        arst = join(path,f)
-        onlypngs = [join(arst,img) for img in listdir(arst) if isfile(join(arst, img)) and img.find('.png')>=0]
+        onlypngs = [k for k in folder.list(f+'/', recursive=False) if k.find('.png')>=0]
         
         this_f = {}
         this_hashes = {}
-        for p in onlypngs:
-            fname = p.split('/')[-1]
-            with open(p,'rb') as fin:
-                q = fin.read()
-                this_f[fname] = q
-                this_hashes[fname] = get_hash(q)
+        for relname in onlypngs:
+            fname = relname.split('/')[-1]
+            p = folder.local_path(relname)
+            key = archive_cache.file_key(p)
+            h = archive_cache.lookup(cached_hashes, relname, key)
+            if h is None:
+                h = hash_file(p)
+            this_f[fname] = ImageHandle(p, h)
+            this_hashes[fname] = h
+            fresh_hashes[relname] = (key, h)
                 
         names.append(f[:-4])
         images.append(this_f)
         hashes.append(this_hashes)
+    
+    if fresh_hashes!=cached_hashes:
+        cache['images'] = fresh_hashes
+        archive_cache.save(path, cache)
         
     imgs = pd.DataFrame({'name':names, 'images':images, 'img_hashes': hashes})
     
     return imgs
 
-def read_daily_images_and_source(path = default_data_location):
-    source = read_daily_source(path)
+def read_daily_images_and_source(path = default_data_location, parse = True):
+    """
+    the soups and images of all snapshots, side by side, in name order.
+    
+    pages are parsed lazily (see `SoupHandle`), so this is cheap once the archive cache is warm.
+    with `parse=False`, there are just the hashes.
+    """
+    source = read_daily_source(path, parse)
     imgs = read_daily_images(path)
     return source.set_index('name').join(imgs.set_index('name')).sort_index().reset_index()
 
@@ -108,25 +293,136 @@ def read_daily_images_and_source(path = default_data_location):
 
 #%% functions for dealing with image--> text data
 
-def add_daily_from_images(df):
-    get_im = lambda row: row['images']['UW-EauClaireCOVID-19DataTrackerDashboardHSTiles_HealthServicesTiles_1.png'] if isinstance(row['images'], dict) else np.nan
-    as_im = lambda row: Image.open(io.BytesIO(get_im(row))) if isinstance(row['images'], dict) else np.nan
+def ocr_cache_location(path = default_data_location):
+    return join(hash_index.meta_location(path), 'ocr_cache.sqlite')
 
-    def as_daily_numbers(row):
-        try:
-            d = ocr_tools.daily_numbers(row['as_image'])
-            return d
-        except AttributeError as e:
-            return np.nan
-        except ValueError as e:
-            return [np.nan, np.nan, np.nan]
+health_services_tile = 'UW-EauClaireCOVID-19DataTrackerDashboardHSTiles_HealthServicesTiles_1.png'
 
-    df['as_image'] = df.apply(as_im, axis=1)
-    df['as_daily_from_image'] = df.apply(as_daily_numbers, axis=1)
+def add_daily_from_images(df, path = default_data_location, workers = None, report = True):
+    """
+    ocr's the daily numbers out of the health services tile of each row.
+    
+    the `as_image` column holds the tile's `ImageHandle`; the file is opened only for the ocr.
+    
+    most consecutive captures have the very same tile, so each distinct tile (by its hash in `img_hashes`)
+    is ocr'd once, and the answer is shared by all the rows that have it.  the ocr runs in parallel, 
+    and results are cached by image hash, so only never-before-seen tiles cost anything.
+    """
+    import numpy as np
+    import ocr_tools
+    get_im = lambda row: row['images'][health_services_tile] if isinstance(row['images'], dict) else np.nan
+
+    df['as_image'] = df.apply(get_im, axis=1)
+    
+    digests = [row['img_hashes'][health_services_tile] if isinstance(row['as_image'], ImageHandle) else None
+               for ii, row in df.iterrows()]
+    distinct = {}
+    for d, h in zip(digests, df['as_image']):
+        if d is not None and d not in distinct:
+            distinct[d] = h.path if h.path is not None else h
+    
+    stats = {}
+    found = ocr_tools.batch_daily_numbers(list(distinct.items()), ocr_cache_location(path), workers, stats)
+    by_digest = dict(zip(distinct.keys(), found))
+    
+    as_daily = [np.nan]*df.shape[0]
+    for ii, d in enumerate(digests):
+        if d is not None:
+            vals = by_digest[d]
+            as_daily[ii] = vals if vals is not None else [np.nan, np.nan, np.nan]
+    df['as_daily_from_image'] = as_daily
+    
+    if report:
+        with_tile = sum(d is not None for d in digests)
+        print('{} rows with a tile, {} distinct tiles, {} already cached: ocr\'d {} in {} tesseract calls, saved {}'.format(
+              with_tile, len(distinct), stats['cached'], stats['ocrd'], stats['tesseract_calls'], with_tile - stats['tesseract_calls']))
     
     return df    
 
 
+def _daily_from_html(name, path = default_data_location):
+    """
+    for one snapshot: its day, by `get_date` (or from its name, if the page has no readable date),
+    and its daily numbers from the html, if its format has a `daily` reader.
+    returns `(name, day, format name, (positives, tests) or None, error or None)`.
+    
+    runs in the worker processes of `daily_numbers_from_archive`.
+    """
+    import contextlib
+    import io
+    data = parse_data(read_snapshot_text(name, path))
+    fmt = detect_format(data)
+    day, numbers, error = name[:10], None, None
+    if fmt is None:
+        return name, day, None, None, None
+    try:
+        day = fmt['get_date'](data).date().isoformat()
+        if fmt['daily'] is not None:
+            with contextlib.redirect_stdout(io.StringIO()): # some extractors print the cells
+                numbers = fmt['daily'](fmt['extract'](data))
+    except (RuntimeError, ValueError, IndexError, AttributeError, KeyError, TypeError) as e:
+        error = repr(e)
+    return name, day, fmt['name'], numbers, error
+
+
+def daily_numbers_from_archive(path = default_data_location, workers = None, report = True):
+    """
+    the daily numbers for every day in the archive, one row per day, in date order, for rebuilding the table.
+    
+    only snapshots with new data are looked at (by hash; see `add_newness`).  each is dated with `get_date`,
+    and its numbers are read from the html if its format has them there (see the format registry),
+    or else ocr'd from its health services tile.  the html is parsed across a pool of `workers` processes,
+    and the ocr is batched and cached (see `add_daily_from_images`).
+    each day gets the numbers of its last new snapshot that had readable ones.
+    
+    columns: date, daily_pos, daily_tests, source ('html' or 'ocr'), snapshot
+    """
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+    df = add_newness(read_daily_images_and_source(path, parse=False))
+    new = df[df['data_was_new']].reset_index(drop=True)
+    
+    names = list(new['name'])
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        from_html = list(pool.map(_daily_from_html, names, [path]*len(names), chunksize=16))
+    days = [r[1] for r in from_html]
+    numbers = [r[3] for r in from_html]
+    sources = ['html' if n is not None else None for n in numbers]
+    
+    need_ocr = [ii for ii, n in enumerate(numbers)
+                if n is None and isinstance(new['img_hashes'][ii], dict) and health_services_tile in new['img_hashes'][ii]]
+    if len(need_ocr)>0:
+        ocrd = add_daily_from_images(new.iloc[need_ocr].copy(), path, workers, report)
+        for ii, vals in zip(need_ocr, ocrd['as_daily_from_image']):
+            if isinstance(vals, tuple):
+                numbers[ii] = vals[:2]
+                sources[ii] = 'ocr'
+    
+    daily = pd.DataFrame({'date': days, 'daily_pos': [n[0] if n is not None else None for n in numbers],
+                          'daily_tests': [n[1] if n is not None else None for n in numbers],
+                          'source': sources, 'snapshot': names})
+    daily = daily[daily['source'].notna()]
+    daily = daily.groupby('date').tail(1).sort_values('date', kind='stable').reset_index(drop=True)
+    
+    if report:
+        errors = [r for r in from_html if r[4] is not None]
+        print('{} snapshots, {} with new data, {} days: {} from html, {} from ocr.  {} snapshots failed to extract'.format(
+              df.shape[0], len(names), daily.shape[0], (daily['source']=='html').sum(), (daily['source']=='ocr').sum(), len(errors)))
+        for r in errors:
+            print('  {} ({}): {}'.format(r[0], r[2], r[4]))
+    return daily
+
+
+def build_table_from_archive(tableCSV, path = default_data_location, start_pos = 0, start_test = 0, workers = None):
+    """
+    regenerates the time series table from the snapshot archive, in one pass.
+    see `daily_numbers_from_archive` for how each day's numbers are found,
+    and `ocr_tools.build_table` for `start_pos` and `start_test`.
+    """
+    import ocr_tools
+    return ocr_tools.build_table(daily_numbers_from_archive(path, workers), tableCSV, start_pos, start_test)
+
+
 
 #%% functions for working with hashes, to determine if there are any duplicate rows.
     
@@ -151,71 +447,133 @@ def which_img_hashes_dont_match(h1, h2):
                 which_match.append(n)  
     return which_match
 
+def image_hash_table(df):
+    """
+    the `img_hashes` column of df, normalized into a long table, with one row per (snapshot, image).
+    
+    columns: `pos` (the snapshot's position in df), `snapshot` (its name), `image_name`,
+    and `digest`, a compact form of the hash -- its first 8 bytes, as a uint64.
+    that's plenty to tell whether two images are the same, and it compares vectorized.
+    """
+    import numpy as np
+    import pandas as pd
+    
+    img_hashes = [h if isinstance(h, dict) else {} for h in df['img_hashes']]
+    pos = np.repeat(np.arange(len(img_hashes)), [len(h) for h in img_hashes])
+    image_names = [n for h in img_hashes for n in h.keys()]
+    digests = np.frombuffer(b''.join(d[:8] for h in img_hashes for d in h.values()), dtype='<u8')
+    
+    return pd.DataFrame({'pos': pos, 'snapshot': df['name'].values[pos],
+                         'image_name': image_names, 'digest': digests})
+
+def changed_image_table(long):
+    """
+    the rows of the long table (see `image_hash_table`) for images that aren't the same 
+    as in the snapshot just before.  an image that wasn't in the previous snapshot at all counts as changed.
+    the first snapshot has nothing to compare to, so nothing in it changed.
+    """
+    prev = long[['pos','image_name','digest']].rename(columns={'digest':'prev_digest'})
+    prev['pos'] = prev['pos'] + 1
+    
+    m = long.merge(prev, on=['pos','image_name'], how='left')
+    changed = (m['prev_digest'].isna() | (m['digest']!=m['prev_digest'])) & (m['pos']>0)
+    return m[changed]
+
+def changed_images(changes, n):
+    """
+    the changed image names of each of `n` snapshots, as a Series of lists, indexed by position.
+    """
+    which = changes.groupby('pos')['image_name'].agg(list).reindex(range(n))
+    return which.apply(lambda x: x if isinstance(x, list) else [])
+
 def img_hash_matches_previous(df):
-    matches = [[]] # preallocate the first one, since this is a consecutive-item operation.
-    for i in range(1,df.shape[0]):   
-        matches.append(which_img_hashes_dont_match(df.iloc[i-1]['img_hashes'],df.iloc[i]['img_hashes']))
-        
-    return matches
+    """
+    for each row, the list of images whose hash differs from the previous row's.
+    """
+    return list(changed_images(changed_image_table(image_hash_table(df)), df.shape[0]))
 
-def find_duplicate_data():
-    df = read_daily_images_and_source()
+def find_duplicate_data(path = default_data_location):
+    df = read_daily_images_and_source(path, parse=False)
     df = add_newness(df)
 
     return (df[~df['data_was_new']])
 
 
 def add_newness(df):
+    changes = changed_image_table(image_hash_table(df))
+    n_changed = changes.groupby('pos').size().reindex(range(df.shape[0]), fill_value=0)
+    
     df['source_is_new'] = source_hash_matches_previous(df)
-    df['image_is_new'] = img_hash_matches_previous(df)
-    df['data_was_new'] = df.apply(lambda row: row['source_is_new'] or len(row['image_is_new'])>0, axis=1)
+    df['image_is_new'] = list(changed_images(changes, df.shape[0]))
+    df['data_was_new'] = df['source_is_new'].values | (n_changed.values>0)
     return df
 
 
 #%% Save and load
 
-def download_img_and_save(url, path):
+def img_filename(url):
     """
-    downloads image to disk, canonicalizing the pathname if suitably named.
+    canonicalizes the filename for an image, if suitably named.
     
-    probably fragile if name pattern changes.
+    probably fragile if name pattern changes.  urls without the uwec dashboard's name in them
+    (other dashboards, or a renamed one) get a name from the last part of their path, prefixed
+    with a hash of the whole url, so different urls never share a file.  the archive only keeps `.png`'s,
+    so that's added if the name doesn't have it.
     """
-    import requests
     a = url.find("UW-EauClaireCOVID-19DataTrackerDashboard")
-    b = len(url)
-    fn = url[a:b].replace('/','_')
-    fn = '{}/{}'.format(path,fn)
-    with open(fn, "wb") as f:
-        f.write(requests.get(url).content)
+    if a>=0:
+        return url[a:].replace('/','_')
+    
+    from urllib.parse import urlsplit
+    base = re.sub(r'[^A-Za-z0-9._-]', '_', urlsplit(url).path.rstrip('/').split('/')[-1]) or 'image'
+    if base.find('.png')<0:
+        base += '.png'
+    return '{}_{}'.format(hashlib.sha256(url.encode('utf-8')).hexdigest()[:16], base)
+
+def download_img_and_save(url, path, session=None):
+    """
+    downloads image to disk, canonicalizing the pathname if suitably named.
+    returns the hash of the image, computed as it was written.
+    """
+    fn = '{}/{}'.format(path,img_filename(url))
+    r, digest = fetching.fetch_to_file(url, fn, session)
+    return digest
             
            
 #%%
         
-def is_new_data(soup):
+def is_new_data(soup, staged=None, path=default_data_location, regions_only=False):
     """
     a wrapper function, checking whether data is new based on all saved criteria
+    
+    `staged` is the result of `stage_tableau_images(soup)`, if the images were already fetched.
+    `regions_only` is passed on to `is_new_based_on_html`.
     """
     
-    return is_new_based_on_html(soup) or is_new_based_on_imgs(soup)
+    return is_new_based_on_html(soup, path, regions_only) or is_new_based_on_imgs(soup, staged, path)
     
-def is_new_based_on_imgs(soup):
+def is_new_based_on_imgs(soup, staged=None, path=default_data_location):
     """
     checks whether the soup is new, based on whether we already have a copy of
     the tableau images.
     
     this was made necessary on sept 25, 2020.
     
-    downloads all images from soup, hashes them.  hashes old images.  
-    sees if there's a new image we didn't already have.
-    deletes temp images.
+    compares the hashes of the staged images from soup against the hashes of the
+    latest saved images.  sees if there's a new image we didn't already have.
     
-    there's an improvement, in that the new images are already downloaded, so if you go on to save the page and its images, the re-download is a waste.  oh well.
+    if `staged` isn't given, the images are staged here and then deleted.  
+    pass in the result of `stage_tableau_images` instead, so that if you go on to save the page,
+    the images don't get downloaded twice.
     """
 
     
     
-    prev_hashes = get_prev_img_hashes()
-    temp_hashes = get_temp_img_hashes(soup)
+    prev_hashes = get_prev_img_hashes(path)
+    if staged is None:
+        temp_hashes = get_temp_img_hashes(soup, path)
+    else:
+        temp_hashes = set(staged[1].values())
 
     if len(temp_hashes.difference(prev_hashes))>0:
         print("new, based on images")
@@ -224,92 +582,384 @@ def is_new_based_on_imgs(soup):
         return False
 
 
-def is_new_based_on_html(soup, path=default_data_location, delete_when_done = True):
+def is_new_based_on_html(soup, path=default_data_location, regions_only = False):
     """
     determines whether the soup is new, based on hashing with stored soups.  
     
-    this should probably also be used in conjunction with other saved data, incase any piece of it changes between crawls.
-    """
-    tmpfname = join(path,"temp_source.tmp")
-    with open(tmpfname,'w', encoding='utf-8') as fout:
-        fout.write(str(soup))
-        
-    with open(tmpfname,'r', encoding='utf-8') as fin:
-        tmp_soup = BeautifulSoup(fin.read(), 'html.parser')
-    
-    if delete_when_done:
-        os.remove(tmpfname)
-        
-    curr_hash = get_hash(tmp_soup)
+    the hash is computed in memory, from one serialization of the soup (see `get_source_hash`),
+    and compared to the latest saved one, from the hash index.
     
+    with `regions_only`, only the data-bearing parts of the page are compared (see `get_region_hash`),
+    so that changes elsewhere on the page don't count as new.
     
+    this should probably also be used in conjunction with other saved data, incase any piece of it changes between crawls.
+    """
+    latest = get_latest_indexed(path)
     
-    prev_source = read_last_soup(path)
-    if curr_hash==get_hash(prev_source):
+    if regions_only and latest is not None and latest[3] is not None:
+        if get_region_hash(soup)==latest[3]:
+            return False
+    elif latest is not None and get_source_hash(soup)==latest[1]:
         return False
-    else:
-        print("new based on source")
-        return True
+    
+    print("new based on source")
+    return True
     
 #%%
 def get_prev_img_hashes(path = default_data_location):
     """
-    computes the hash of all saved images in all image folders in `path`
+    gets the hashes of the images of the latest saved snapshot in `path`,
+    from the hash index.
     returns a `set` of the hashes.
     """
     
-    f = get_last_image_folder(path)
-    hashes = set()
-    
-    arst = join(path,f)
-    onlypngs = [join(arst,img) for img in listdir(arst) if isfile(join(arst, img)) and img.find('.png')>=0]
-    for p in onlypngs:
-        with open(p,'rb') as fin:
-            q = fin.read()
-            
-            hashes.add(get_hash(q))
-                
+    latest = get_latest_indexed(path)
+    if latest is None:
+        return set()
+    return set(latest[2].values())
+
+
+def hash_image_folder(name, path = default_data_location):
+    """
+    computes the hashes of the png's in the image folder of the snapshot `name`, in the plain layout.
+    returns a dict from image filename to hash; empty if it has no image folder.
+    """
+    folder = storage.open_folder(path)
+    hashes = {}
+    onlypngs = [k for k in folder.list(name+'imgs/', recursive=False) if k.find('.png')>=0]
+    for k in onlypngs:
+        hashes[k.split('/')[-1]] = hash_file(folder.local_path(k))
     return hashes
+
+
+def hash_file(fn):
+    """
+    the hash of a file's contents, read a chunk at a time.  same as `get_hash` of its bytes.
+    """
+    n = hashlib.sha256()
+    with open(fn,'rb') as fin:
+        for chunk in iter(lambda: fin.read(fetching.chunk_size), b''):
+            n.update(chunk)
+    return n.digest()
+
+
+def get_source_hash(soup):
+    """
+    the hash of the soup, as the text it will be saved as (see `source_hash_of_text`).
+    """
+    return source_hash_of_text(str(soup))
+
+
+def get_region_hash(soup):
+    """
+    a hash of just the data-bearing parts of the soup: the table cells, the h4 headings
+    (which have the dates), and the tableau images' urls.
+    """
+    n = hashlib.sha256()
+    for el in soup.find_all(['td','h4','img','param']):
+        if el.name=='img':
+            n.update(el.get('src','').encode('utf-8'))
+        elif el.name=='param':
+            n.update(el.get('value','').encode('utf-8'))
+        else:
+            n.update(normalize_newlines(el.get_text()).encode('utf-8'))
+        n.update(b'\0')
+    return n.digest()
+
+
+def normalize_newlines(text):
+    return text.replace('\r\n','\n').replace('\r','\n')
+
+
+def source_hash_of_text(text):
+    """
+    the hash of a snapshot's html, from its `text` as saved.  this is the one canonical source hash:
+    it's what `save_html` and `save_to_store` record, what `index_snapshot` and `migrate` recompute
+    from the saved files, and what `read_daily_source` reports.
+    
+    newlines are normalized, as text-mode reading does.  the text is never re-parsed, since bs4 doesn't
+    serialize a re-parsed page identically (it adds a newline after a doctype, each time round).
+    for text that is `str(soup)`, the result is the same as `get_hash(soup)`.
+    """
+    n = hashlib.sha256()
+    n.update(get_hash(normalize_newlines(text)))
+    return n.digest()
+
+
+def get_latest_indexed(path = default_data_location):
+    """
+    returns `(name, source_hash, img_hashes, region_hash)` for the latest saved snapshot,
+    from the hash index.
+    
+    the latest is the one `latest_snapshot_name` finds, so a newest snapshot deleted by hand
+    isn't compared against.  if it isn't indexed (say, on an archive made before there was an index),
+    it's indexed first.  returns `None` for an empty archive.
+    """
+    name = latest_snapshot_name(path)
+    if name is None:
+        return None
+    latest = hash_index.snapshot(path, name)
+    if latest is None:
+        index_named_snapshot(name, path)
+        latest = hash_index.snapshot(path, name)
+    return latest
+
+
+def index_snapshot(htmlfile, path = default_data_location):
+    """
+    hashes one saved snapshot (its html file and its image folder, if it has one),
+    and records the hashes in the index.
+    """
+    from bs4 import BeautifulSoup
+    name = htmlfile[:-5]
+    text = read_snapshot_text(name, path)
+    soup = BeautifulSoup(text, 'html.parser')
+    img_hashes = hash_image_folder(name, path)
     
-def get_temp_img_hashes(soup, delete_when_done = True):
+    hash_index.record_snapshot(path, name, source_hash_of_text(text), img_hashes, get_region_hash(soup))
+
+
+def index_stored_snapshot(name, path = default_data_location):
+    """
+    records the hashes from a store manifest in the index.  no hashing needed.
+    """
+    manifest = read_stored_manifest(name, path)
+    hash_index.record_snapshot(path, name, manifest['source_hash'],
+                               {img: bytes.fromhex(h) for img, h in manifest['images'].items()})
+
+
+def index_named_snapshot(name, path = default_data_location):
+    """
+    `index_snapshot` or `index_stored_snapshot`, whichever the archive's layout needs.
+    """
+    if blob_store.in_use(path):
+        index_stored_snapshot(name, path)
+    else:
+        index_snapshot(name+'.html', path)
+
+
+def migrate_to_store(path = default_data_location, remove_old = False, store = None):
+    """
+    moves an archive of html files and image folders into a content-addressed store (see `blob_store`),
+    and re-indexes it.  safe to re-run.  the old files are only deleted if `remove_old`.
+    
+    the store is made in place, unless `store` is another location, like `s3://bucket/prefix` (see `storage`).
+    """
+    blob_store.migrate(path, source_hash_of_text, remove_old, store)
+    rebuild_hash_index(store if store is not None else path)
+
+
+def rebuild_hash_index(path = default_data_location):
+    """
+    re-hashes every snapshot in the archive into the index.  slow, but only
+    needed if the index is lost or the archive was edited by hand.
+    also resets the latest pointer and the name counters.
+    """
+    names = scan_snapshot_names(path)
+    hash_index.rebuild_names(path, names)
+    if blob_store.in_use(path):
+        for name in names:
+            index_stored_snapshot(name, path)
+        return
+    
+    for name in names:
+        index_snapshot(name+'.html', path)
+    
+def get_temp_img_hashes(soup, path=default_data_location):
     """
     computes the hash of all new images.  returns a `set` of them.
     
-    works by making a tempdir, and downloading the images to it.
-    computes the hashes
-    deletes the tempdir
-    """
-    tempdir = join(default_data_location,"tempimgs")
-    if not os.path.exists(tempdir):
-        os.mkdir(tempdir)
-    save_all_tableau_images(soup, tempdir)
-    temp_hashes = set()
-    
-    onlypngs = [f for f in listdir(tempdir) if isfile(join(tempdir, f)) and f.find('.png')>=0]
-    for img in onlypngs:
-        with open(join(tempdir,img),'rb') as fin:
-            q = fin.read()
-            temp_hashes.add(get_hash(q))
-            
-    if delete_when_done:
-        import shutil
-        shutil.rmtree(tempdir)
+    works by staging the images, computing the hashes, and deleting the staging folder.
+    """
+    staged = stage_tableau_images(soup, path)
+    discard_staged(staged)
+    
+    return set(staged[1].values())
+
+
+def stage_tableau_images(soup, path=default_data_location, conditional=True, stats=None, image_urls=None, filename=img_filename):
+    """
+    downloads all the tableau images from soup into a fresh staging folder,
+    outside the data location.
+    
+    if `conditional`, asks the server for each image only if it changed since we last fetched it.
+    images the server says are unchanged are copied from the latest saved snapshot instead.
     
-    return temp_hashes
+    returns `(stagedir, img_hashes, validators)`, where img_hashes is a dict from image filename to hash,
+    and validators is a list of http cache entries to record once the poll is done.
+    hand this to `is_new_data` and `save_html`, so the images are only fetched once.
+    clean up with `discard_staged` when done.
+    
+    `stats`, a `poll_stats.PollStats`, counts the images fetched and reused, and the bytes downloaded.
+    `image_urls` picks the images out of the soup; by default, `tableau_image_urls`.
+    `filename` names each image's file from its url (see `register_extractor`).
+    """
+    return stage_images((image_urls or tableau_image_urls)(soup), path, conditional, stats, filename=filename)
+
+
+def stage_images(urls, path=default_data_location, conditional=True, stats=None, reuse=True, filename=img_filename):
+    """
+    `stage_tableau_images`, for a list of image `urls`.
     
+    with `reuse=False`, images the server says are unchanged are only noted, not copied in,
+    for when the staging may well be thrown away.  `fill_staged` copies them in, if it's kept.
+    """
+    import tempfile
+    stagedir = tempfile.mkdtemp(prefix='uwec_imgs_')
+    
+    cached = {u: hash_index.get_http_cache(path, u) for u in urls} if conditional else {}
+    jobs = [(u, join(stagedir, filename(u)), fetching.conditional_headers(cached.get(u))) for u in urls]
+    responses = fetching.fetch_all(jobs, stats=stats)
+    
+    latest = hash_index.latest_snapshot(path) if conditional else None
+    img_hashes = {}
+    validators = []
+    for (u, fn, headers), (r, digest) in zip(jobs, responses):
+        if r.status_code==304:
+            if not reuse:
+                img_hashes[filename(u)] = cached[u]['digest']
+                validators.append(cached[u])
+                continue
+            if reuse_saved_image(fn, cached[u]['digest'], latest, path):
+                img_hashes[filename(u)] = cached[u]['digest']
+                validators.append(cached[u])
+                if stats is not None:
+                    stats.count('images_reused')
+                continue
+            r, digest = fetching.fetch_to_file(u, fn, stats=stats)
+        if stats is not None:
+            stats.count('images_fetched')
+        img_hashes[filename(u)] = digest
+        validators.append(validators_from_response(u, r, digest=digest))
+    
+    return stagedir, img_hashes, validators
+
+
+def fill_staged(staged, path=default_data_location, stats=None, filename=img_filename):
+    """
+    copies in the images `stage_images(..., reuse=False)` only noted, from the archive,
+    or downloads them again if they aren't there.  `filename` must be the one they were staged with.
+    """
+    stagedir, img_hashes, validators = staged
+    latest = hash_index.latest_snapshot(path)
+    for ii, v in enumerate(validators):
+        fn = join(stagedir, filename(v['url']))
+        if isfile(fn):
+            continue
+        if reuse_saved_image(fn, v['digest'], latest, path):
+            if stats is not None:
+                stats.count('images_reused')
+            continue
+        r, digest = fetching.fetch_to_file(v['url'], fn, stats=stats)
+        if stats is not None:
+            stats.count('images_fetched')
+        img_hashes[filename(v['url'])] = digest
+        validators[ii] = validators_from_response(v['url'], r, digest=digest)
+
+
+def reuse_saved_image(fn, digest, latest, path=default_data_location):
+    """
+    copies the image with hash `digest` from the latest saved snapshot to `fn`, if it's there.
+    returns whether it was.
+    """
+    if blob_store.in_use(path):
+        if not blob_store.has_blob(path, digest.hex()):
+            return False
+        blob_store.get_file(path, digest.hex(), fn)
+        return True
+    
+    if latest is None:
+        return False
+    imgname = fn.split('/')[-1]
+    if latest[2].get(imgname)!=digest:
+        return False
+    folder = storage.open_folder(path)
+    saved = '{}imgs/{}'.format(latest[0], imgname)
+    if not folder.exists(saved):
+        return False
+    folder.get_to_file(saved, fn)
+    return True
+
+
+def validators_from_response(url, r, links=None, digest=None):
+    """
+    the http cache entry for a response, for use in a later conditional request.
+    
+    pass the `digest` of the body for streamed responses.
+    """
+    if digest is None:
+        digest = get_hash(r.content)
+    return {'url': url, 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'),
+            'digest': digest, 'links': links if links is not None else []}
+
+
+def staged_images_changed(staged, path=default_data_location):
+    """
+    whether any of the `staged` images (see `stage_images`) differs from when we last fetched it,
+    or was never fetched before, going by the http cache.
+    """
+    for v in staged[2]:
+        cached = hash_index.get_http_cache(path, v['url'])
+        if cached is None or cached['digest']!=v['digest']:
+            return True
+    return False
+
+
+def discard_staged(staged):
+    """
+    removes the staging folder, if it's still around (it isn't, if it got saved).
+    """
+    import shutil
+    shutil.rmtree(staged[0], ignore_errors=True)
     
 
 def get_all_image_folders(path):
-    return [f for f in listdir(path) if isdir(join(path, f)) and f.find("imgs")>=0 and f.find("temp")<0]
+    return [f for f in storage.open_folder(path).folders() if f.find("imgs")>=0 and f.find("temp")<0]
 
 
 def get_last_image_folder(path):
+    name = latest_snapshot_name(path)
+    if name is not None and storage.open_folder(path).has_folder(name+'imgs'):
+        return name+'imgs'
+    
     img_folders = get_all_image_folders(path)
     img_folders.sort()
     f = img_folders[-1]
     return f
 
 
+def scan_snapshot_names(path=default_data_location):
+    """
+    the names of all the snapshots in the archive, sorted, from a listing of it.
+    """
+    if blob_store.in_use(path):
+        return blob_store.snapshot_names(path)
+    return sorted(f[:-5] for f in storage.open_folder(path).list('', recursive=False) if f.endswith('.html'))
+
+
+def snapshot_exists(name, path=default_data_location):
+    if blob_store.in_use(path):
+        return blob_store.has_manifest(path, name)
+    return storage.open_folder(path).exists(name+'.html')
+
+
+def latest_snapshot_name(path=default_data_location):
+    """
+    the name of the newest snapshot, like `2020-09-25T10.00.00_0`, or `None` for an empty archive.
+    
+    read from the pointer the save path keeps in the hash index, so the archive isn't listed.
+    if the pointer is missing, or points at a snapshot that's gone, the archive is scanned
+    and the pointer (and the name counters) rebuilt.
+    """
+    name = hash_index.latest_name(path)
+    if name is not None and snapshot_exists(name, path):
+        return name
+    
+    names = scan_snapshot_names(path)
+    hash_index.rebuild_names(path, names)
+    return names[-1] if len(names)>0 else None
+
+
 
 def get_hash(thing):
     """
@@ -323,8 +973,12 @@ def get_hash(thing):
         n.update(thing.encode('utf-8' ))
     elif isinstance(thing, bytes):
         n.update(thing)
-    elif isinstance(thing,BeautifulSoup):
+    elif type(thing).__name__=='BeautifulSoup':
         n.update(get_hash(str(thing)))
+    elif isinstance(thing, ImageHandle):
+        return thing.hash()
+    elif isinstance(thing, SoupHandle):
+        return thing.digest
     else:
         raise RuntimeError("unknown type: {}".format(str(type(thing))))
             
@@ -333,101 +987,352 @@ def get_hash(thing):
 def gen_filename_from_date(path,date,autoincrement = True):
     """
     makes a datetime object into a valid filename, using the iso format
+    
+    works on an archive of html files, or one in store mode.
+    
+    the counter is claimed from the hash index, which keeps the highest one used for each timestamp,
+    so the archive isn't listed.  if the name it hands out is somehow taken already
+    (say, files copied in by hand), the counters are rebuilt from a scan, and it tries again.
     """
     
     fname = date.isoformat().replace(':','.')
     
+    counter = 0
     if autoincrement:
-
-        onlyfiles = [f for f in listdir(path) if isfile(join(path, f)) and f!='.DS_Store']
-        
-        found_numbers = [int(f.strip('.html').split('_')[1]) for f in onlyfiles if fname == f[0:len(fname)] ]
-            
-        highest = -1         
-        if len(found_numbers)>0:
-            highest = max(found_numbers)
+        scan = lambda: scan_snapshot_names(path)
+        counter = hash_index.next_counter(path, fname, scan)
+        rebuilt = False
+        while snapshot_exists("{}_{}".format(fname,counter), path) or storage.open_folder(path).has_folder("{}_{}imgs".format(fname,counter)):
+            if not rebuilt:
+                hash_index.rebuild_names(path, scan())
+                rebuilt = True
+            counter = hash_index.next_counter(path, fname, scan)
     
-    return "{}/{}_{}.html".format(path,fname,highest+1)
+    return "{}/{}_{}.html".format(path,fname,counter)
 
 #%%
-def save_all_tableau_images(soup, path):
+def tableau_image_urls(soup):
     """
-    saves all images from soup, that have the word "tableau" in the url, to the specified path.
+    the urls of all images from soup that have the word "tableau" in the url.
     """
+    urls = []
     
     imgs = soup.find_all('img')
     for im in imgs:
         s = im['src']
         if s.find('tableau')>=0:
-            download_img_and_save(s,path)
+            urls.append(s)
     
     params = soup.find_all('param')
     for p in params:
         n = p['name']
         if n.find('static_image')==0:
             if p['value'].find('tableau'):
-                download_img_and_save(p['value'],path)
+                urls.append(p['value'])
+    
+    return urls
+
+def save_all_tableau_images(soup, path, session=None):
+    """
+    saves all images from soup, that have the word "tableau" in the url, to the specified path.
+    
+    the downloads happen concurrently, over the shared session.
+    returns a dict from image filename to hash, computed as the images were written.
+    """
+    jobs = [(u, '{}/{}'.format(path,img_filename(u))) for u in tableau_image_urls(soup)]
+    responses = fetching.fetch_all(jobs, session)
+    return {img_filename(u): digest for (u, fn), (r, digest) in zip(jobs, responses)}
                 
     
-def save_html(soup, date, path=default_data_location):
+def save_html(soup, date, path=default_data_location, staged=None):
     """
     required arg: soup -- a result from the .content attribute of getting a page with BS.
     
     optional arg: date as a datetime object.  
     if not supplied, will use the current time.
+    
+    optional arg: staged -- the result of `stage_tableau_images(soup)`.
+    if supplied, the staged images are moved into place rather than downloaded again.
+    
+    the files are written through `storage.open_folder`, each atomically, images first and the html last,
+    so a half-saved snapshot is never taken for a whole one.
     """
-    import os
     if type(date)!=datetime:
         raise TypeError("date must be a `datetime` object")
             
     
-    fname = gen_filename_from_date(path,date)
+    if blob_store.in_use(path):
+        return save_to_store(soup, date, path, staged)
     
+    fname = gen_filename_from_date(path,date)
+    name = fname.split('/')[-1][:-5]
+    folder = storage.open_folder(path)
     
-    p = fname[:-5]+'imgs'
-    os.mkdir(p)
-    save_all_tableau_images(soup, p)
-    
-    with open(fname,'w', encoding='utf-8') as fout:
-        fout.write(str(soup))
+    own_staging = staged is None
+    if own_staging:
+        staged = stage_tableau_images(soup, path, conditional=False)
+    try:
+        imgs = sorted(img for img in listdir(staged[0]) if isfile(join(staged[0], img)))
+        folder.put_files([('{}imgs/{}'.format(name, img), join(staged[0], img)) for img in imgs], move=True)
+    finally:
+        if own_staging:
+            discard_staged(staged)
+    img_hashes = staged[1]
+    
+    folder.put(name+'.html', str(soup).encode('utf-8'))
+    hash_index.record_snapshot(path, name, get_source_hash(soup), img_hashes, get_region_hash(soup))
         
     print("saved soup to file `{}`".format(fname))
     return fname
 
+def save_to_store(soup, date, path=default_data_location, staged=None):
+    """
+    like `save_html`, but for an archive in store mode (see `blob_store`).
+    images and html that are already in the store aren't stored again.
+    
+    returns the filename of the snapshot's manifest.
+    """
+    name = gen_filename_from_date(path,date).split('/')[-1][:-5]
+    fname = join(blob_store.manifest_dir(path), name+'.html')
+    
+    own_staging = staged is None
+    if own_staging:
+        staged = stage_tableau_images(soup, path, conditional=False)
+    try:
+        text = normalize_newlines(str(soup))
+        source_hash = get_source_hash(soup)
+        blob_store.save_snapshot(path, name, text, source_hash, staged[0], staged[1], move=True)
+    finally:
+        if own_staging:
+            discard_staged(staged)
+    
+    hash_index.record_snapshot(path, name, source_hash, staged[1], get_region_hash(soup))
+    
+    fname = fname[:-5]+'.json'
+    print("saved soup to store, manifest `{}`".format(fname))
+    return fname
+
 def gather_current(url=URL):
     """
     gets the soup for the page, as it is currently on yon internet
     """
-    page = requests.get(url)
+    from bs4 import BeautifulSoup
+    page = fetching.get(url)
     soup = BeautifulSoup(page.content, 'html.parser')
     return soup
 
+
+def gather_if_changed(url=URL, path=default_data_location, conditional=True, stats=None, image_urls=None):
+    """
+    gets the soup for the page, but only if it changed since the last poll.
+    
+    sends the etag / last-modified from the last poll, and if the server says 304,
+    or sends back the exact same bytes, doesn't bother parsing.
+    
+    returns `(soup, validators)`.  soup is `None` if the page is unchanged.
+    validators is the http cache entry for the page, to record once the poll is done.
     
-def gather_and_save(url=URL,even_if_old = False):
+    `stats`, a `poll_stats.PollStats`, times the fetch and the parse, and counts the bytes.
+    `image_urls` picks the images out of the soup, to remember; by default, `tableau_image_urls`.
+    """
+    import poll_stats
+    cached = hash_index.get_http_cache(path, url) if conditional else None
+    with poll_stats.stage(stats, 'fetch_page'):
+        page = fetching.get(url, headers=fetching.conditional_headers(cached))
+    if stats is not None:
+        stats.count('requests')
+        stats.count('bytes_downloaded', len(page.content))
+    
+    if page.status_code==304:
+        if stats is not None:
+            stats.count('not_modified')
+            stats.count('page_unchanged')
+        return None, cached
+    
+    digest = get_hash(page.content)
+    if cached is not None and digest==cached['digest']:
+        if stats is not None:
+            stats.count('page_unchanged')
+        return None, validators_from_response(url, page, cached['links'], digest)
+    
+    from bs4 import BeautifulSoup
+    with poll_stats.stage(stats, 'parse'):
+        soup = BeautifulSoup(page.content, 'html.parser')
+    return soup, validators_from_response(url, page, (image_urls or tableau_image_urls)(soup), digest)
+
+    
+def gather_and_save(url=URL,even_if_old = False, path=default_data_location, regions_only = False,
+                    stats = None, stats_log = None, prom_file = None, extractor = 'uwec'):
     """
     gets the current soup, as on the internet. 
     checks if we already have it.  
     - if do, no save.  
     - if not, autosave using date, defaulting to now in case can't read date from page (sept 25 mod to source made this necessary.)
     
+    uses conditional requests, so if neither the page nor its images changed since the last poll,
+    nothing is downloaded or parsed, and `None` is returned.  otherwise returns the soup.
+    
+    with `regions_only`, only changes to the data-bearing parts of the page count as new (see `is_new_based_on_html`).
+    
     there is an option to save even if we already have it.  this is guaranteed to not overwrite old data, because every data has an incremented counter in its name.  huzzah.
-    """
     
-    soup = gather_current(url=url)
+    every run is timed, stage by stage, and its counters (bytes downloaded, images fetched vs reused, 304s)
+    are printed as one json line at the end, and appended to `stats_log` if given.
+    `prom_file` is (over)written with the same, in prometheus text format.  see `poll_stats`.
     
+    `extractor` names the registered extractor (see `register_extractor`) that knows how to read
+    the page's date, which of its images to keep, and what to name them.  the default is for the uwec dashboard.
+    """
+    import poll_stats
+    if stats is None:
+        stats = poll_stats.PollStats()
+    ex = extractors[extractor]
+    
+    staged = None
     try:
-        date = get_date(soup)
-    except RuntimeError as e:
-        now = datetime.now()
-        date = datetime(now.year,now.month,now.day,now.hour,now.minute,now.second)
-        print('unable to read date from source :(   using datestring {}'.format(date))
+        soup, page_validators = gather_if_changed(url, path, stats=stats, image_urls=ex['image_urls'])
+        if soup is None:
+            # the page is the same, but its images might not be.  they're staged (conditionally) to find out,
+            # and if they did change, that staging is what gets saved.
+            with stats.stage('check_images'):
+                staged = stage_images(page_validators['links'], path, stats=stats, reuse=False, filename=ex['filename'])
+            if not even_if_old and not staged_images_changed(staged, path):
+                hash_index.record_http_cache(path, [page_validators])
+                stats.outcome = 'unchanged'
+                print('already had the data, page unchanged since last poll')
+                return None
+            soup, page_validators = gather_if_changed(url, path, conditional=False, stats=stats, image_urls=ex['image_urls'])
         
-    if even_if_old or is_new_data(soup):
-        save_html(soup, date)
-    else:
-        print('already had the data from {}'.format(date))
-    return soup
+        with stats.stage('get_date'):
+            try:
+                date = ex['get_date'](soup)
+            except RuntimeError as e:
+                now = datetime.now()
+                date = datetime(now.year,now.month,now.day,now.hour,now.minute,now.second)
+                print('unable to read date from source :(   using datestring {}'.format(date))
+        
+        if staged is None or [v['url'] for v in staged[2]]!=page_validators['links']:
+            if staged is not None: # the page changed in between, after all
+                discard_staged(staged)
+            with stats.stage('stage_images'):
+                staged = stage_images(page_validators['links'], path, stats=stats, filename=ex['filename'])
+        else:
+            with stats.stage('stage_images'):
+                fill_staged(staged, path, stats, ex['filename'])
+        with stats.stage('is_new'):
+            new = even_if_old or is_new_data(soup, staged, path, regions_only)
+        if new:
+            with stats.stage('save'):
+                save_html(soup, date, path, staged)
+            stats.outcome = 'saved'
+        else:
+            stats.outcome = 'duplicate'
+            print('already had the data from {}'.format(date))
+        hash_index.record_http_cache(path, [page_validators] + staged[2])
+        return soup
+    except Exception:
+        stats.outcome = 'error'
+        raise
+    finally:
+        if staged is not None:
+            discard_staged(staged)
+        stats.emit(stats_log, prom_file)
+
+
+# what `gather_and_save` needs to know about a dashboard: how to read the date off its page,
+# which of its images are data to be kept, and what to call them.  other dashboards register their own.
+extractors = {}
+
+def register_extractor(name, get_date, image_urls, filename=img_filename):
+    """
+    `get_date` takes the soup and returns a datetime, raising RuntimeError if it can't.
+    `image_urls` takes the soup and returns the urls of the images to save with it.
+    `filename` takes an image url and returns the name of its file in the snapshot, which must be
+    different for each of the page's images, and the same from one poll to the next.
+    by default, `img_filename`.
+    """
+    extractors[name] = {'name': name, 'get_date': get_date, 'image_urls': image_urls, 'filename': filename}
+
+register_extractor('uwec', lambda soup: get_date(soup), tableau_image_urls) # get_date is further down
+
+
+
 
+#%% Parsing, for the extractors
+#
+# the extractors below only ever look at the td, h4, img and param elements,
+# so for bulk work over the archive there's no need to build the whole tree.
+# `parse_data` builds just those subtrees, with lxml if it's installed,
+# and hands back a `DataElements`, which the extractors take in place of a soup.
+#
+# hashing must stay on full html.parser soups, so the hashes match the saved ones.
+
+data_tags = ['td','h4','img','param']
+
+def default_parser():
+    """
+    lxml if it's installed, since it's several times faster.  otherwise python's own.
+    """
+    return 'lxml' if importlib.util.find_spec('lxml') is not None else 'html.parser'
+
+
+class DataElements:
+    """
+    the td, h4, img and param elements of a page, collected in one pass, in document order.
+    
+    has a `find_all(tag)` like a soup's, for just those tags, so the extractors can take one of these instead.
+    """
+    __slots__ = ('by_tag',)
+    
+    def __init__(self, by_tag):
+        self.by_tag = by_tag
+    
+    def find_all(self, name):
+        return self.by_tag.get(name, [])
+    
+    findAll = find_all
+
+
+def scan_data_elements(soup):
+    """
+    collects the data-bearing elements of a soup (or of a strained parse) in one pass.
+    """
+    by_tag = {t: [] for t in data_tags}
+    for el in soup.find_all(data_tags):
+        by_tag[el.name].append(el)
+    return DataElements(by_tag)
+
+
+def parse_data(text, parser = None):
+    """
+    parses html `text`, building only the td, h4, img and param subtrees.
+    returns a `DataElements`.
+    """
+    from bs4 import BeautifulSoup, SoupStrainer
+    if parser is None:
+        parser = default_parser()
+    strained = BeautifulSoup(text, parser, parse_only=SoupStrainer(data_tags))
+    return scan_data_elements(strained)
+
+
+def read_daily_data(path = default_data_location, parser = None):
+    """
+    like `read_daily_source`, but parses only what the extractors need (see `parse_data`).
+    the `data` column holds `DataElements`.  much faster, and lighter, over the whole archive.
+    """
+    import pandas as pd
+    names = scan_snapshot_names(path)
+    data = [parse_data(read_snapshot_text(n, path), parser) for n in names]
+    return pd.DataFrame({'name':names, 'data':data})
+
+
+def read_snapshot_text(name, path = default_data_location):
+    """
+    the html of one snapshot, as text, from its file or from the store.
+    """
+    if blob_store.in_use(path):
+        return blob_store.get_bytes(path, read_stored_manifest(name, path)['html']).decode('utf-8')
+    return normalize_newlines(storage.open_folder(path).get(name+'.html').decode('utf-8'))
 
 
 
@@ -491,15 +1396,13 @@ def get_date_til_sept25(soup):
     raise RuntimeError('unable to find Mo. DD format')
     
     
-# a stupid wrapper function because of varying date formats.
+# a wrapper function because of varying date formats.
+# picks the date parser for the page's format straight away (see the format registry, below).
 def get_date(soup):
-    try:
-        return get_date_til_sept14_2(soup)
-    except RuntimeError as e1:
-        try:
-            return get_date_til_sept25(soup)
-        except RuntimeError:
-            raise e1
+    fmt = detect_format(soup)
+    if fmt is None:
+        raise RuntimeError('unable to find MM/DD/YY or Mo. DD format')
+    return fmt['get_date'](soup)
     
     
 
@@ -519,6 +1422,7 @@ def get_col_labels_early_sept14(data_cells):
     return col_labels
 
 def process_rectangular_data_early_sept14(soup):
+    import pandas as pd
     from collections import defaultdict
     
     data_cells = soup.find_all('td')
@@ -550,6 +1454,7 @@ def process_data_early_sept14(soup):
 #%% sept 10
     
 def process_data_sept10(soup):
+    import pandas as pd
     data_cells = soup.find_all('td')
     print(data_cells)
     
@@ -598,9 +1503,159 @@ def process_data_sept10(soup):
     return UWEC, OtherData
 
 #%%
+
+
+
+#%% Format registry
+#
+# the page has changed format several times.  each format is registered here, with a cheap `detect` check,
+# the function that reads its date, and the function that extracts its data (`None` if its data isn't in the html).
+# a new format plugs in with `register_format`, without touching the old ones.
+#
+# the newest format is tried first.  fallbacks -- formats we can only read the date of, which detect on
+# the date style alone -- are tried after all the others.
+#
+# detection is memoized on a fingerprint of the page's cell layout, so across the archive
+# each layout is only detected once.
+
+formats = []
+_format_by_layout = {}
+
+def register_format(name, detect, get_date, extract = None, fallback = False, daily = None):
+    """
+    adds a page format.  the latest registered is tried first, but after any non-fallbacks if it's a `fallback`.
     
+    `detect` takes a soup (or `DataElements`) and says whether the page is in this format.
+    `daily` takes what `extract` returns, and picks out the day's `(positives, tests)`, for the table.
+    """
+    fmt = {'name': name, 'detect': detect, 'get_date': get_date, 'extract': extract, 'fallback': fallback, 'daily': daily}
+    first_fallback = next((ii for ii, f in enumerate(formats) if f['fallback']), len(formats))
+    formats.insert(first_fallback if fallback else 0, fmt)
+    _format_by_layout.clear()
+
+
+def cell_texts(soup):
+    return [c.get_text() for c in soup.find_all('td')]
+
+
+def h4_date_style(soup):
+    """
+    which of the known date styles the page's h4 headings use: 'mm/dd/yy', 'mon. dd', or `None`.
     
+    mm/dd/yy wins if any h4 has it, whatever comes first, as it did when `get_date` tried
+    `get_date_til_sept14_2` on all of them before `get_date_til_sept25`.
+    """
+    import unicodedata
+    h4 = soup.find_all('h4')
+    for h in h4:
+        if re.search('([0-9]+:[0-9]+ [a,p].m. [0-9]+/[0-9]+/[0-9]+)', str(h.findAll(text=True))) is not None:
+            return 'mm/dd/yy'
+    for h in h4:
+        t = unicodedata.normalize("NFKD", str(h.find(text=True)))
+        if re.search('([0-9]+:[0-9]+ [a,p].m. [A-z]+. [0-9]+)', t) is not None:
+            return 'mon. dd'
+    return None
+
+
+def layout_fingerprint(soup):
+    """
+    a structural hash of the page: how many cells it has, which are numbers and what the others say,
+    and its date style.  pages in the same format, on different days, have the same fingerprint.
+    """
+    n = hashlib.sha256()
+    for t in cell_texts(soup):
+        t = t.strip()
+        n.update(b'#' if re.fullmatch('[0-9,.%]+', t) else t[:40].encode('utf-8'))
+        n.update(b'\0')
+    n.update(str(h4_date_style(soup)).encode('utf-8'))
+    return n.digest()
+
+
+def detect_format(soup):
+    """
+    the registered format the page is in, or `None`.
+    """
+    fp = layout_fingerprint(soup)
+    if fp not in _format_by_layout:
+        _format_by_layout[fp] = next((f for f in formats if f['detect'](soup)), None)
+    return _format_by_layout[fp]
+
+
+def _has_numbers(cells, which):
+    return len(cells)>max(which) and all(re.search('[0-9]', cells[ii]) is not None for ii in which)
+
+def is_sept10(soup):
+    return h4_date_style(soup)=='mm/dd/yy' and _has_numbers(cell_texts(soup), [5,6,7,9,10,11,15,17,19,21,23])
+
+def is_early_sept14(soup):
+    cells = cell_texts(soup)
+    return (h4_date_style(soup)=='mm/dd/yy' and _has_numbers(cells, [1,2,3,4,5,31,32,33,34,35])
+            and len(cells)>17 and all(re.search('[0-9]', cells[ii]) is None for ii in range(13,18)))
 
+def is_til_sept14_2(soup):
+    return h4_date_style(soup)=='mm/dd/yy'
+
+def is_til_sept25(soup):
+    return h4_date_style(soup)=='mon. dd'
+
+
+def daily_sept10(extracted):
+    """
+    today's positives, and today's tests, pcr and antigen together, from `process_data_sept10`.
+    """
+    UWEC, OtherData = extracted
+    today = dict(zip(UWEC['What'], UWEC['Today']))
+    return int(today['Positive cases']), int(today['Total # PCR Tests'] + today['Total # of Antigen tests'])
+
+def daily_early_sept14(extracted):
+    """
+    positives and tests from `process_data_early_sept14`, going by the page's own labels:
+    the columns labelled positive and test(s), in the row labelled total (or summed over the rows, if there's none).
+    raises ValueError if the labels don't say.
+    """
+    rect, vect = extracted
+    cols = [c for c in rect.columns if c!='row_labels']
+    pos = [c for c in cols if 'positive' in c.lower() and '%' not in c]
+    tests = [c for c in cols if 'test' in c.lower() and '%' not in c and c not in pos]
+    if len(pos)!=1 or len(tests)!=1:
+        raise ValueError('no single positives and tests column in {}'.format(cols))
     
+    total = rect[rect['row_labels'].str.lower().str.contains('total')]
+    rows = total if total.shape[0]==1 else rect
+    return int(rows[pos[0]].sum()), int(rows[tests[0]].sum())
+
+
+# oldest first, since each registration goes in front.
+register_format('sept10', is_sept10, get_date_til_sept14_2, process_data_sept10, daily=daily_sept10)
+register_format('early_sept14', is_early_sept14, get_date_til_sept14_2, process_data_early_sept14, daily=daily_early_sept14)
+register_format('til_sept14_2', is_til_sept14_2, get_date_til_sept14_2, fallback=True)
+register_format('til_sept25', is_til_sept25, get_date_til_sept25, fallback=True)
+
+
+def extract_all(path = default_data_location, parser = None):
+    """
+    reads the whole archive (see `read_daily_data`), and runs each snapshot through the parsers of its format.
     
-    
\ No newline at end of file
+    returns a DataFrame with the snapshot `name`, its `format` (`None` if unrecognized), `date`, 
+    the extracted `data` (`None` if the format has no extractor), and any `error` from extracting.
+    """
+    import pandas as pd
+    df = read_daily_data(path, parser)
+    
+    fmts, dates, data, errors = [], [], [], []
+    for d in df['data']:
+        fmt = detect_format(d)
+        fmts.append(fmt['name'] if fmt is not None else None)
+        date, extracted, error = None, None, None
+        if fmt is not None:
+            try:
+                date = fmt['get_date'](d)
+                if fmt['extract'] is not None:
+                    extracted = fmt['extract'](d)
+            except (RuntimeError, ValueError, IndexError, AttributeError, KeyError) as e:
+                error = repr(e)
+        dates.append(date)
+        data.append(extracted)
+        errors.append(error)
+    
+    return pd.DataFrame({'name': df['name'], 'format': fmts, 'date': dates, 'data': data, 'error': errors})